@@ -2,12 +2,15 @@
 
 import aiohttp
 import asyncio
-from fastapi import FastAPI, Form
+from fastapi import FastAPI, Form, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from datetime import datetime
 from typing_extensions import Annotated
-from bs4 import BeautifulSoup, Tag
-from datetime import datetime
+from bs4 import Tag
+from parsing import make_soup, parse_time, get_course_details
+from portal import aiub_portal_url
+import curriculum_graph
+import deadlines
 import os
 import re
 import random
@@ -28,8 +31,6 @@ async def cors(request, call_next):
     response.headers["Access-Control-Allow-Origin"] = client_url
     return response
 
-default_parser = 'html.parser'
-
 emojis = {
     '😊',
     '😉',
@@ -74,140 +75,111 @@ class UserData(BaseModel):
     Password: str
 
 @app.post('/')
-async def login(data: any):
+async def login(request: Request):
 
     print('Processing request...')
 
-    url = 'https://portal.aiub.edu'
-
-    print(data)
+    url = aiub_portal_url
 
-    user_name = ""
-    password = ""
+    form = await request.form()
+    user_name = form.get('UserName', '')
+    password = form.get('Password', '')
 
-    async with aiohttp.ClientSession() as session:
+    deadline = deadlines.Deadline(deadlines.LOGIN_DEADLINE)
+    # Each stage gets its share of the deadline, requests only their connect and read timeouts
+    timeout = aiohttp.ClientTimeout(connect=deadlines.PORTAL_CONNECT_TIMEOUT, sock_read=deadlines.PORTAL_READ_TIMEOUT)
+    # unsafe=True keeps cookies for IP hosts too, so it can run against fake_portal.py
+    async with aiohttp.ClientSession(timeout=timeout, cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
         try:
 
-            print(f'Logging in with {user_name}... and {password}')
-            async with session.post(url, data={'UserName': user_name, 'Password': password}) as resp:
-                if resp.status != 200:
+            print(f'Logging in with {user_name}...')
+            with deadline.stage('login'):
+                status, resp_url = await deadline.run(post_login(session, url, user_name, password))
+                if status != 200:
                     return {'success': False, 'message': 'Error in request'}
-                
-                print('Checking response...', resp.url)
 
-                if 'https://portal.aiub.edu/Student' not in str(resp.url):
-                    return {'success': False, 'message': 'Invalid username or password - ' + str(resp.url)}
-                
-                if 'Student/Tpe/Start' in str(resp.url):
+                print('Checking response...', resp_url)
+
+                if f'{url}/Student' not in resp_url:
+                    return {'success': False, 'message': 'Invalid username or password - ' + resp_url}
+
+                if 'Student/Tpe/Start' in resp_url:
                     print('Evaluation pending')
                     return {'success': False, 'message': 'TPE Evaluation pending on portal'}
 
                 print('Login successful')
 
-                async with session.get('https://portal.aiub.edu/Student') as res:
-                    
-                    soup = BeautifulSoup(await res.text(), default_parser)
-                    targets = soup.select("#SemesterDropDown > option")
-                    user = soup.select_one('.navbar-link').text
-                    # if user has , in his name, then split it by , and then reverse it
-                    if ',' in user:
-                        user = user.split(',')
-                        user = user[1].strip() + ' ' + user[0].strip()
-
-                    user = user.title()
-
-                    current_semester = soup.select_one('#SemesterDropDown > option[selected="selected"]').text
-                    semester_class_routine = {}
-
-                    tasks = [process_semester(session, target) for target in targets]
-
-                    result = await asyncio.gather(get_curricumn_data(session), get_completed_courses(session, current_semester), *tasks)
-
-                    course_map = result[0]
-                    completed_courses = result[1][0]
-                    current_semester_courses = result[1][1]
-                    pre_registered_courses = result[1][2]
-
-                    for semester in result[2:]:
-                        semester_class_routine.update(semester)
-
-                    # sort the semesters by year
-                    semester_class_routine = dict(sorted(semester_class_routine.items(), key=lambda x: x[0]))
-
-                    #iterate over the gradesMap. A student can take a course after completing the prerequisites. And also if he/she has taken the course before, he must have D grade
-                    unlocked_courses = {}
-                    for course_code, course in completed_courses.items():
-                        #if student has taken the course before and has D grade, then he/she can take the course again
-                        if course['grade'] == 'D':
-                            unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course_map[course_code]['credit'], 'prerequisites': course_map[course_code]['prerequisites'], 'retake': True}
-
-                    completed_courses, unlocked_courses = post_process(course_map, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses)
-
-                            
-                print('Sending response...')
-                return {'success': True, 'message': 'Success', 'result': { 'semesterClassRoutine': semester_class_routine, 'unlockedCourses': unlocked_courses, 'completedCourses': completed_courses, 'preregisteredCourses': pre_registered_courses, 'currentSemester': current_semester, 'user': user}}
+                home = await deadline.run(get_text(session, f'{url}/Student'))
+
+            soup = make_soup(home)
+            targets = soup.select("#SemesterDropDown > option")
+            user = soup.select_one('.navbar-link').text
+            # if user has , in his name, then split it by , and then reverse it
+            if ',' in user:
+                user = user.split(',')
+                user = user[1].strip() + ' ' + user[0].strip()
+
+            user = user.title()
+
+            current_semester = soup.select_one('#SemesterDropDown > option[selected="selected"]').text
+            semester_class_routine = {}
+
+            # The stages run at the same time, each within its own budget
+            stages = [
+                asyncio.ensure_future(deadline.run_stage('curriculum', get_curricumn_data(session))),
+                asyncio.ensure_future(deadline.run_stage('grades', get_completed_courses(session, current_semester))),
+                asyncio.ensure_future(deadline.run_stage('semesters', process_semesters(session, targets))),
+            ]
+            try:
+                course_map, courses, semesters = await asyncio.gather(*stages)
+            finally:
+                # Once one stage failed nobody waits for the others
+                for stage in stages:
+                    stage.cancel()
+
+            completed_courses = courses[0]
+            current_semester_courses = courses[1]
+            pre_registered_courses = courses[2]
+
+            for semester in semesters:
+                semester_class_routine.update(semester)
+
+            # sort the semesters by year
+            semester_class_routine = dict(sorted(semester_class_routine.items(), key=lambda x: x[0]))
+
+            # D grades can be retaken, other courses need their prerequisites completed or in progress
+            curriculum_graph.add_credits(completed_courses, course_map)
+            unlocked_courses = curriculum_graph.unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses)
+
+            print('Sending response...')
+            return {'success': True, 'message': 'Success', 'result': { 'semesterClassRoutine': semester_class_routine, 'unlockedCourses': unlocked_courses, 'completedCourses': completed_courses, 'preregisteredCourses': pre_registered_courses, 'currentSemester': current_semester, 'user': user}}
+        except deadlines.StageTimeout as e:
+            print(f'Login timed out in stage {e.stage}')
+            return JSONResponse({'success': False, 'message': f'{e}. The portal is slow, try again later', 'stage': e.stage}, status_code=504)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'Portal not responding: {e!r}')
+            return {'success': False, 'message': 'AIUB portal is not responding. Try again later'}
         except Exception as e:
             print(e)
             return {'success': False, 'message': 'Error in request'}
 
-def is_course_code_skippable(course_code: str) -> bool:
-    return '#' in course_code or '*' in course_code
-
-def is_in_current_semester(course_code: str, course: dict, current_semester_courses: dict) -> bool:
-    return (
-        course_code in current_semester_courses and
-        course["course_name"] == current_semester_courses[course_code]["course_name"] and
-        current_semester_courses[course_code]['grade'] not in ['W', 'I', 'UW']
-    )
-
-def is_course_unlocked(prerequisites: list, completed_courses: dict, current_semester_courses: dict) -> bool:
-    if not prerequisites:
-        return True
-    return all(
-        prerequisite in completed_courses or prerequisite in current_semester_courses
-        for prerequisite in prerequisites
-    )
-
-def post_process(course_map, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses):
-    for course_code, course in course_map.items():
-        if course_code in completed_courses:
-            completed_courses[course_code]['credit'] = course['credit']
-            continue
-        if is_course_code_skippable(course_code):
-            continue
-        if course['course_name'] == 'INTERNSHIP':
-            continue
-        if course_code in unlocked_courses:
-            continue
-        if is_in_current_semester(course_code, course, current_semester_courses):
-            continue
-        if course_code in pre_registered_courses:
-            unlocked_courses[course_code] = {
-                'course_name': course['course_name'],
-                'credit': course['credit'],
-                'prerequisites': course['prerequisites'],
-                'retake': False
-            }
-            continue
-        
-        if is_course_unlocked(course['prerequisites'], completed_courses, current_semester_courses):
-            unlocked_courses[course_code] = {
-                'course_name': course['course_name'],
-                'credit': course['credit'],
-                'prerequisites': course['prerequisites'],
-                'retake': False
-            }
-
-    return completed_courses, unlocked_courses
+
+async def post_login(session: aiohttp.ClientSession, url: str, user_name: str, password: str):
+    # Status and final url of the login POST, after its redirects
+    async with session.post(url, data={'UserName': user_name, 'Password': password}) as resp:
+        return resp.status, str(resp.url)
 
 
+async def get_text(session: aiohttp.ClientSession, url: str) -> str:
+    async with session.get(url) as response:
+        return await response.text()
 
 
 async def get_completed_courses(session: aiohttp.ClientSession, current_semester: str): #gets all completed and attempted courses from the grade report
     # get the completed courses
     print('Getting completed courses...')
-    async with session.get('https://portal.aiub.edu/Student/GradeReport/ByCurriculum') as response:
-        soup = BeautifulSoup(await response.text(), default_parser)
+    async with session.get(f'{aiub_portal_url}/Student/GradeReport/ByCurriculum') as response:
+        soup = make_soup(await response.text())
         rows = soup.select('table:not(:first-child) tr:not(:first-child):has(td:nth-child(3):not(:empty))')
         # first td contains the course code, second td contains the course name, third td contains the grade
         completed_courses = {}
@@ -250,8 +222,8 @@ async def get_completed_courses(session: aiohttp.ClientSession, current_semester
 async def get_curricumn_data(session: aiohttp.ClientSession):
     print('Getting curriculum data...')
     # get the curriculum data
-    async with session.get('https://portal.aiub.edu/Student/Curriculum') as response:
-        soup = BeautifulSoup(await response.text(), default_parser)
+    async with session.get(f'{aiub_portal_url}/Student/Curriculum') as response:
+        soup = make_soup(await response.text())
         target_elements = soup.select('[curriculumid]')
         curricumn_id = []
         for target in target_elements:
@@ -273,9 +245,9 @@ async def get_curricumn_data(session: aiohttp.ClientSession):
 async def process_curriculum(id: str, session: aiohttp.ClientSession):
     # request the getCurricumnLink?IDd=curriculumId
     course_map = {}
-    #print(f'Getting data for curriculum https://portal.aiub.edu/Common/Curriculum?ID={ID}')
-    async with session.get(f'https://portal.aiub.edu/Common/Curriculum?ID={id}') as response:
-        soup = BeautifulSoup(await response.text(), default_parser)
+    #print(f'Getting data for curriculum {aiub_portal_url}/Common/Curriculum?ID={ID}')
+    async with session.get(f'{aiub_portal_url}/Common/Curriculum?ID={id}') as response:
+        soup = make_soup(await response.text())
         table = soup.select('.table-bordered tr:not(:first-child)')
         #print(f'{len(table)} courses extracted')
 
@@ -292,6 +264,10 @@ async def process_curriculum(id: str, session: aiohttp.ClientSession):
         return course_map
 
 
+async def process_semesters(session: aiohttp.ClientSession, targets: list):
+    return await asyncio.gather(*[process_semester(session, target) for target in targets])
+
+
 async def process_semester(session: aiohttp.ClientSession, target: Tag):
     semester = {}
     match = re.search(r'q=(.*)', target.attrs['value'])
@@ -299,10 +275,10 @@ async def process_semester(session: aiohttp.ClientSession, target: Tag):
     if match is not None and len(match.groups()) < 1:
         return
     
-    rq_url = 'https://portal.aiub.edu/Student/Registration?q=' + match.group(1)
+    rq_url = f'{aiub_portal_url}/Student/Registration?q=' + match.group(1)
 
     async with session.get(rq_url) as response:
-        soup = BeautifulSoup(await response.text(), default_parser)
+        soup = make_soup(await response.text())
         raw_course_elements = soup.select("table")[1].select("td:first-child")
 
         if len(raw_course_elements) == 0:
@@ -337,59 +313,3 @@ async def process_semester(session: aiohttp.ClientSession, target: Tag):
         semester[target.text] = courses_obj
 
     return semester
-
-
-
-
-
-
-def parse_time(time_string: str):
-    try:
-        match = re.findall(r'\d{1,2}:\d{1,2}(?:\s?[ap]m|\s?[AP]M)?', time_string)
-        day_map = {'Sun': 'Sunday', 'Mon': 'Monday', 'Tue': 'Tuesday', 'Wed': 'Wednesday', 'Thu': 'Thursday', 'Fri': 'Friday', 'Sat': 'Saturday'}
-        class_type = re.search(r'\((.*?)\)', time_string).group(1)
-        day = day_map[re.search(r'(Sun|Mon|Tue|Wed|Thu|Fri|Sat)', time_string).group()]
-        room = re.search(r'Room: (.*)', time_string).group(1)
-        start_time, end_time = match[0], match[1]
-        start_time_obj = ''
-        end_time_obj = ''
-        #if time contains am/pm or AM/PM
-        AM_TIME_FORMAT = '%I:%M'
-        PM_TIME_FORMAT =  AM_TIME_FORMAT + ' %p'
-        if "am" in start_time.lower() or "pm" in start_time.lower():
-            start_time_obj = datetime.strptime(start_time, PM_TIME_FORMAT)
-        else:
-            start_time_obj = datetime.strptime(start_time, AM_TIME_FORMAT)
-        if "am" in end_time.lower() or "pm" in end_time.lower():
-            end_time_obj = datetime.strptime(end_time, PM_TIME_FORMAT)
-        else:
-            end_time_obj = datetime.strptime(end_time, AM_TIME_FORMAT)
-
-        start_time_formatted = start_time_obj.strftime(PM_TIME_FORMAT)
-        end_time_formatted = end_time_obj.strftime(PM_TIME_FORMAT)
-        final_time = f"{start_time_formatted} - {end_time_formatted}"
-        data = {
-            "type": class_type,
-            "time": final_time,
-            "day": day,
-            "room": room
-        }
-        return data
-    except IndexError:
-        print("Time not found in the string.")
-
-
-def get_course_details(course: str):
-    match = re.match(r"^(\d+)-(.+?)\s+\[([A-Z0-9]+)\](?:\s+\[([A-Z0-9]+)\])?$", course)
-    try:
-        if match:
-            class_id = match.group(1)
-            course_name = match.group(2).title()
-            section = match.group(4) if match.group(4) else match.group(3)
-            return {"class_id": class_id, "course_name": course_name, "section": section}
-        else:
-            print("Course not found in the string:", course)
-            return {"class_id": "", "course_name": "", "section": ""}
-    except IndexError:
-        print("Course not found in the string:", course)
-        return {"class_id": "", "course_name": "", "section": ""}
\ No newline at end of file
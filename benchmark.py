@@ -0,0 +1,338 @@
+# Benchmarks for the scraping pipeline
+# Usage: python benchmark.py <name> [options]
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import tracemalloc
+import zlib
+from datetime import datetime
+
+import requests
+from bs4 import SoupStrainer
+
+# notice.py connects to Redis at import time, the benchmarks don't need a live server
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379')
+
+import curriculum_graph
+import events
+import fake_portal
+import main_sse
+import notice
+import parsing
+import portal
+from fake_portal import FIXTURES_DIR, load_fixture
+from parsing import make_soup
+from tests.unlock_reference import legacy_unlocked_courses, synthetic_curriculum, synthetic_student
+
+
+async def blocking_event_stream(username: str, password: str):
+    # The pre-aiohttp pipeline: same portal round-trips, made with blocking requests calls
+    base = portal.aiub_portal_url
+    session = requests.Session()
+    session.post(base, data={'UserName': username, 'Password': password})
+    yield 'logged in'
+    soup = make_soup(session.get(base + '/Student').text)
+    targets = soup.select('#SemesterDropDown > option')
+    soup = make_soup(session.get(base + '/Student/Curriculum').text)
+    for target in soup.select('[curriculumid]'):
+        session.get(f'{base}/Common/Curriculum?ID={target.attrs["curriculumid"]}')
+    session.get(base + '/Student/GradeReport/ByCurriculum')
+    for target in targets:
+        session.get(base + target.attrs['value'])
+        yield target.text
+
+
+async def consume(stream) -> float:
+    start = time.perf_counter()
+    async for _ in stream:
+        pass
+    return time.perf_counter() - start
+
+
+async def run_concurrent(make_stream, users: int) -> dict:
+    start = time.perf_counter()
+    durations = await asyncio.gather(*[consume(make_stream(f'user-{i}', 'secret')) for i in range(users)])
+    wall = time.perf_counter() - start
+    return {'users': users, 'wall_s': round(wall, 3), 'mean_login_s': round(sum(durations) / users, 3), 'max_login_s': round(max(durations), 3)}
+
+
+def bench_concurrency(args):
+    portal.aiub_portal_url = fake_portal.start_in_thread(latency=args.latency)
+    results = {
+        'latency_s': args.latency,
+        'before_blocking_requests': asyncio.run(run_concurrent(blocking_event_stream, args.users)),
+        'after_aiohttp': asyncio.run(run_concurrent(main_sse.event_stream, args.users)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+async def scrape_fixtures() -> dict:
+    # Output of every page scraper on the recorded pages
+    async with portal.new_session() as session:
+        await portal.login(session, 'user', 'secret')
+        targets = make_soup(await portal.get_page(session, '/Student')).select('#SemesterDropDown > option')
+        notices = notice.select_notices(load_fixture('aiub_home.html'))
+        return {
+            'process_curriculum': await main_sse.process_curriculum('101', session),
+            'get_completed_courses': await main_sse.get_completed_courses(session, 'Spring 2024-25'),
+            'process_semester': await main_sse.process_semester(targets[1], session),
+            'format_notice': [notice.format_notice(n) for n in notices],
+        }
+
+
+def time_call(fn, iterations: int) -> float:
+    # Mean milliseconds per call
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return round((time.perf_counter() - start) * 1000 / iterations, 3)
+
+
+def bench_parsers(args):
+    portal.aiub_portal_url = fake_portal.start_in_thread()
+    backends = parsing.available_parsers()
+
+    outputs = {}
+    for backend in backends:
+        parsing.set_parser(backend)
+        outputs[backend] = asyncio.run(scrape_fixtures())
+
+    # Every backend must give the same scraper output as html.parser
+    reference = outputs['html.parser']
+    parity = {backend: {name: output == reference[name] for name, output in outputs[backend].items()} for backend in backends}
+
+    pages = {name: load_fixture(name) for name in sorted(os.listdir(FIXTURES_DIR))}
+    parse_ms = {}
+    for backend in backends:
+        parsing.set_parser(backend)
+        parse_ms[backend] = {name: time_call(lambda: make_soup(html), args.iterations) for name, html in pages.items()}
+        parse_ms[backend]['total'] = round(sum(parse_ms[backend].values()), 3)
+
+    print(json.dumps({'parity': parity, 'parse_ms': parse_ms}, indent=2))
+
+
+def synthetic_grade_report(rows: int) -> str:
+    # Grade report with the same layout as the portal's, split into tables of 25 courses
+    rng = random.Random(rows)
+    grades = ['A+', 'A', 'B+', 'B', 'C+', 'C', 'D+', 'D', 'F', 'W', 'UW', '-']
+    semesters = ['Fall 2021-22', 'Spring 2021-22', 'Summer 2021-22', 'Fall 2022-23', 'Spring 2022-23', 'Spring 2024-25']
+    tables = ['<table class="table"><tr><td>Student</td><td>DOE, JOHN</td></tr></table>']
+    for start in range(0, rows, 25):
+        body = ['<tr><th>Course Code</th><th>Course Name</th><th>Results</th></tr>']
+        for i in range(start, min(start + 25, rows)):
+            attempts = ' '.join(f'({rng.choice(semesters)}) [{rng.choice(grades)}]' for _ in range(rng.choice([0, 1, 1, 1, 2])))
+            if not attempts:
+                attempts = rng.choice(['', ' ', '\r\n    ', '<!-- not taken -->'])
+            body.append(f'<tr><td>CSC{1000 + i}</td><td>COURSE {i}</td><td>{attempts}</td></tr>')
+        tables.append('<table class="table table-bordered">' + ''.join(body) + '</table>')
+    return '<html><body><div>' + ''.join(tables) + '</div></body></html>'
+
+
+def selector_grade_report(soup, current_semester: str):
+    # The selector based extraction get_completed_courses used before the single-pass walk
+    completed_courses, current_semester_courses, pre_registered_courses = {}, {}, {}
+    valid_grades = ['A+', 'A', 'B+', 'B', 'C+', 'C', 'D+', 'D', 'F']
+    for row in soup.select('table:not(:first-child) tr:not(:first-child):has(td:nth-child(3):not(:empty))'):
+        course_code = row.select_one('td:nth-child(1)').text.strip()
+        course_name = row.select_one('td:nth-child(2)').text.strip()
+        results = row.select_one('td:nth-child(3)').text.strip()
+        matches = re.findall(r'\(([^)]+)\)\s*\[([^\]]+)\]', results)
+        if matches:
+            semester, grade = matches[-1]
+            grade, semester = grade.strip(), semester.strip()
+            if grade == '-':
+                main_sse.handle_incomplete_grade(matches, course_code, course_name, semester, current_semester, completed_courses, current_semester_courses, pre_registered_courses, valid_grades)
+            elif grade in valid_grades:
+                completed_courses[course_code] = {'course_name': course_name, 'grade': grade, 'semester': semester}
+    return [completed_courses, current_semester_courses, pre_registered_courses]
+
+
+def bench_grade_report(args):
+    soup = make_soup(synthetic_grade_report(args.rows))
+    before = selector_grade_report(soup, 'Spring 2024-25')
+    after = main_sse.process_grade_report(soup, 'Spring 2024-25')
+    selector_ms = time_call(lambda: selector_grade_report(soup, 'Spring 2024-25'), args.iterations)
+    single_pass_ms = time_call(lambda: main_sse.process_grade_report(soup, 'Spring 2024-25'), args.iterations)
+    print(json.dumps({
+        'rows': args.rows,
+        'same_output': before == after,
+        'courses': [len(courses) for courses in after],
+        'selector_ms': selector_ms,
+        'single_pass_ms': single_pass_ms,
+        'speedup': round(selector_ms / single_pass_ms, 1),
+    }, indent=2))
+
+
+def peak_kib(fn) -> float:
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def bench_partial(args):
+    # Full tree vs only the subtree the scraper reads, on the recorded pages
+    pages = {
+        'registration.html': (SoupStrainer('table'), 'table', parsing.TABLE_PAGE_PARSERS),
+        'curriculum_101.html': (parsing.class_strainer('table-bordered'), '.table-bordered tr:not(:first-child)', parsing.PARTIAL_PARSERS),
+        'aiub_home.html': (parsing.class_strainer('notice-page'), '.notice-page .notification', parsing.PARTIAL_PARSERS),
+    }
+    results = {'parser': parsing.HTML_PARSER}
+    for name, (strainer, selector, parsers) in pages.items():
+        html = load_fixture(name)
+        full = lambda: make_soup(html).select(selector)
+        partial = lambda: parsing.select_partial(html, strainer, selector, parsers=parsers)
+        results[name] = {
+            'same_output': [str(e) for e in full()] == [str(e) for e in partial()],
+            'full_ms': time_call(full, args.iterations),
+            'partial_ms': time_call(partial, args.iterations),
+            'full_peak_kib': peak_kib(full),
+            'partial_peak_kib': peak_kib(partial),
+        }
+    print(json.dumps(results, indent=2))
+
+
+def uncached_parse_time(time_string: str):
+    # parse_time as it was copied into main.py, app.py and main_sse.py
+    try:
+        match = re.findall(r'\d{1,2}:\d{1,2}(?:\s?[ap]m|\s?[AP]M)?', time_string)
+        day_map = {'Sun': 'Sunday', 'Mon': 'Monday', 'Tue': 'Tuesday', 'Wed': 'Wednesday', 'Thu': 'Thursday', 'Fri': 'Friday', 'Sat': 'Saturday'}
+        class_type = re.search(r'\((.*?)\)', time_string).group(1)
+        day = day_map[re.search(r'(Sun|Mon|Tue|Wed|Thu|Fri|Sat)', time_string).group()]
+        room = re.search(r'Room: (.*)', time_string).group(1)
+        start_time, end_time = match[0], match[1]
+        AM_TIME_FORMAT = '%I:%M'
+        PM_TIME_FORMAT = AM_TIME_FORMAT + ' %p'
+        if "am" in start_time.lower() or "pm" in start_time.lower():
+            start_time_obj = datetime.strptime(start_time, PM_TIME_FORMAT)
+        else:
+            start_time_obj = datetime.strptime(start_time, AM_TIME_FORMAT)
+        if "am" in end_time.lower() or "pm" in end_time.lower():
+            end_time_obj = datetime.strptime(end_time, PM_TIME_FORMAT)
+        else:
+            end_time_obj = datetime.strptime(end_time, AM_TIME_FORMAT)
+        final_time = f"{start_time_obj.strftime(PM_TIME_FORMAT)} - {end_time_obj.strftime(PM_TIME_FORMAT)}"
+        return {"type": class_type, "time": final_time, "day": day, "room": room}
+    except IndexError:
+        print("Time not found in the string.")
+
+
+def uncached_get_course_details(course: str):
+    # get_course_details as it was copied into main.py, app.py and main_sse.py
+    match = re.match(r"^(\d+)-(.+?)\s+\[([A-Z0-9]+)\](?:\s+\[([A-Z0-9]+)\])?$", course)
+    if match:
+        section = match.group(4) if match.group(4) else match.group(3)
+        return {"class_id": match.group(1), "course_name": match.group(2).title(), "section": section}
+    return {"class_id": "", "course_name": "", "section": ""}
+
+
+def routine_corpus(size: int):
+    # Class slots and course titles as many students' routines would contain them:
+    # a few hundred distinct values, popular ones repeating far more than the rest
+    rng = random.Random(size)
+    days = ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Sat']
+    clocks = ['8:00 - 9:30', '9:30 - 11:00', '11:00 - 12:30', '12:30 - 2:00', '2:00 - 3:30', '3:30 - 5:00', '8:00 am - 11:00 am', '2:00 pm - 5:00 pm']
+    rooms = [str(r) for r in range(100, 160)] + [f'D{r}' for r in range(300, 320)]
+    slots = [f'Time: {rng.choice(days)} {rng.choice(clocks)} ({rng.choice(["Theory", "Lab"])}) Room: {rng.choice(rooms)}' for _ in range(800)]
+    titles = [f'{rng.randint(1000, 9999)}-COURSE NUMBER {i} [{rng.choice("ABCDEFGH")}]' for i in range(300)]
+    pick = lambda values: values[min(int(rng.paretovariate(0.5)) - 1, len(values) - 1)]
+    return [pick(slots) for _ in range(size)], [pick(titles) for _ in range(size)]
+
+
+def bench_routine_parsing(args):
+    slots, titles = routine_corpus(args.corpus)
+    parsing.parse_time_cached.cache_clear()
+    parsing.get_course_details_cached.cache_clear()
+    same = [uncached_parse_time(slot) for slot in slots] == [parsing.parse_time(slot) for slot in slots]
+    same = same and [uncached_get_course_details(title) for title in titles] == [parsing.get_course_details(title) for title in titles]
+    parsing.parse_time_cached.cache_clear()
+    parsing.get_course_details_cached.cache_clear()
+    timings = {
+        'parse_time_before_ms': time_call(lambda: [uncached_parse_time(slot) for slot in slots], args.iterations),
+        'parse_time_after_ms': time_call(lambda: [parsing.parse_time(slot) for slot in slots], args.iterations),
+        'get_course_details_before_ms': time_call(lambda: [uncached_get_course_details(title) for title in titles], args.iterations),
+        'get_course_details_after_ms': time_call(lambda: [parsing.get_course_details(title) for title in titles], args.iterations),
+    }
+    print(json.dumps({'corpus': args.corpus, 'distinct_slots': len(set(slots)), 'same_output': same, **timings, 'parse_time_cache': str(parsing.parse_time_cached.cache_info())}, indent=2))
+
+
+async def senior_result() -> dict:
+    # Complete result of a login against the stand-in portal, 12 semesters of routines
+    # Progress, queue and partial events come first, the login is read to the end so it finishes normally
+    result = None
+    async for payload in main_sse.event_stream('user', 'secret'):
+        if payload['status'] in ['complete', 'error']:
+            result = payload
+    return result
+
+
+def bench_payload(args):
+    portal.aiub_portal_url = fake_portal.start_in_thread(latency=0)
+    payload = asyncio.run(senior_result())
+    before = f'data: {json.dumps(payload)}\n\n'.encode('utf-8')
+    after = events.format_event(payload)
+
+    def gzip_kib(data: bytes) -> float:
+        compressor = zlib.compressobj(events.SSE_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+        return round(len(compressor.compress(data) + compressor.flush()) / 1024, 1)
+
+    results = {
+        'serializer': 'orjson' if events.orjson is not None else 'json',
+        'same_payload': json.loads(before[6:]) == json.loads(after[6:]),
+        'encode_before_ms': time_call(lambda: f'data: {json.dumps(payload)}\n\n'.encode('utf-8'), args.iterations),
+        'encode_after_ms': time_call(lambda: events.format_event(payload), args.iterations),
+        'json_kib': round(len(before) / 1024, 1),
+        'compact_json_kib': round(len(after) / 1024, 1),
+        'compact_json_gzip_kib': gzip_kib(after),
+    }
+    print(json.dumps(results, indent=2))
+
+
+def bench_unlocked(args):
+    rng = random.Random(7)
+    course_map = synthetic_curriculum(args.courses, rng)
+    students = [synthetic_student(course_map, rng) for _ in range(args.students)]
+
+    # tests/test_curriculum_graph.py checks both give the same output
+    def run(fn):
+        for completed, current, pre_registered in students:
+            fn(course_map, completed, current, pre_registered)
+
+    compile_ms = time_call(lambda: curriculum_graph.CurriculumGraph(course_map), args.iterations)
+    print(json.dumps({
+        'courses': len(course_map),
+        'students': args.students,
+        'legacy_ms': time_call(lambda: run(legacy_unlocked_courses), args.iterations),
+        'graph_ms': time_call(lambda: run(curriculum_graph.unlocked_courses), args.iterations),
+        'compile_ms': compile_ms,
+    }, indent=2))
+
+
+BENCHMARKS = {
+    'concurrency': bench_concurrency,
+    'parsers': bench_parsers,
+    'grade_report': bench_grade_report,
+    'partial': bench_partial,
+    'routine_parsing': bench_routine_parsing,
+    'payload': bench_payload,
+    'unlocked': bench_unlocked,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the scraping pipeline')
+    parser.add_argument('name', choices=BENCHMARKS.keys())
+    parser.add_argument('--users', type=int, default=20, help='Concurrent logins')
+    parser.add_argument('--latency', type=float, default=0.05, help='Stand-in portal latency per request (seconds)')
+    parser.add_argument('--iterations', type=int, default=50, help='Iterations per timed call')
+    parser.add_argument('--rows', type=int, default=200, help='Courses in the synthetic grade report')
+    parser.add_argument('--corpus', type=int, default=5000, help='Class slots and course titles in the routine corpus')
+    parser.add_argument('--courses', type=int, default=2000, help='Courses in the synthetic curriculum')
+    parser.add_argument('--students', type=int, default=200, help='Synthetic students per timed call')
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
@@ -0,0 +1,72 @@
+import os
+import time
+
+import metrics
+
+# Circuit breaker for the portal. After enough consecutive failures (5xx, timeouts, refused
+# connections) the circuit opens and portal requests fail at once instead of waiting on a
+# portal that is down. After a cooldown one probe request is let through: if it succeeds
+# the circuit closes again, if not it stays open for another cooldown
+
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))  # Consecutive failures that open the circuit
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))  # Seconds the circuit stays open before a probe
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # Values of the state gauge
+
+
+class PortalUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False  # A half-open probe is in flight
+        metrics.PORTAL_CIRCUIT.set(STATES[self.state])
+
+    def set_state(self, state: str):
+        if state != self.state:
+            print(f'Portal circuit {state}')
+        self.state = state
+        metrics.PORTAL_CIRCUIT.set(STATES[state])
+
+    def is_open(self) -> bool:
+        # True while requests would be refused, without taking the probe
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at < BREAKER_COOLDOWN
+        return self.state == HALF_OPEN and self.probing
+
+    def before(self):
+        # Raises PortalUnavailable unless a request may go to the portal now
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                raise PortalUnavailable()
+            self.set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self.probing:
+                raise PortalUnavailable()
+            self.probing = True
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        self.set_state(CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or self.failures >= BREAKER_FAILURES:
+            self.opened_at = time.monotonic()
+            self.set_state(OPEN)
+
+    def abandon(self):
+        # The request ended without telling us anything about the portal
+        self.probing = False
+
+
+breaker = CircuitBreaker()
@@ -0,0 +1,164 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+import redis
+import redis.asyncio as aioredis
+from cryptography.fernet import Fernet, InvalidToken
+
+from notice import REDIS_URL
+
+# Shared cache: an in-process L1 in front of the Redis instance notice.py uses
+
+L1_CACHE_SIZE = int(os.environ.get('L1_CACHE_SIZE', 256))  # Max entries kept per process
+L1_CACHE_TTL = int(os.environ.get('L1_CACHE_TTL', 300))  # L1 entries expire sooner so Redis stays the source of truth
+
+FILL_LOCK_TTL = 30  # Seconds a worker may hold the fill lock of a key
+FILL_WAIT = 10  # Seconds other workers wait for the lock holder before filling themselves
+
+# Seconds the last login result of a user is kept to be shown while a fresh scrape runs
+SNAPSHOT_TTL = int(os.environ.get('SNAPSHOT_TTL', 14 * 24 * 60 * 60))
+
+# Server secret mixed into every per-user key. All workers must share it
+CACHE_SECRET = os.environ.get('CACHE_SECRET', '')
+if CACHE_SECRET == '':
+    # Without a secret the keys and ciphers would only be hashes of the credentials. A random one keeps them
+    # secret, but other workers can't share this one's logins, cookies and snapshots, and a restart loses them
+    CACHE_SECRET = secrets.token_hex(32)
+    print('CACHE_SECRET is not set, using a random secret for this process only')
+
+# Async client, short timeouts so a dead Redis only costs us the cache
+ar = aioredis.Redis.from_url(REDIS_URL, socket_connect_timeout=1, socket_timeout=1)
+
+_l1 = {}  # key -> (expires_at, value)
+_fill_locks = {}  # key -> asyncio.Lock, one filler per key in this process
+
+
+def l1_get(key: str):
+    entry = _l1.get(key)
+    if entry is None:
+        return None
+    if entry[0] < time.monotonic():
+        _l1.pop(key, None)
+        return None
+    return entry[1]
+
+
+def l1_set(key: str, value, ttl: int):
+    _l1.pop(key, None)
+    if len(_l1) >= L1_CACHE_SIZE:
+        # Dicts keep insertion order, so the first key is the oldest one
+        _l1.pop(next(iter(_l1)))
+    _l1[key] = (time.monotonic() + min(ttl, L1_CACHE_TTL), value)
+
+
+async def get_or_fill(key: str, ttl: int, fill):
+    # Return the cached value of key, calling fill() at most once per key across all workers.
+    # Empty values are returned but never cached
+    value = l1_get(key)
+    if value is not None:
+        return value
+
+    lock = _fill_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        # Someone else may have filled it while we waited for the lock
+        value = l1_get(key)
+        if value is None:
+            value = await fill_shared(key, ttl, fill)
+            if value:
+                l1_set(key, value, ttl)
+        return value
+
+
+async def get_cached(key: str):
+    # Cached value of key, None if no worker has filled it
+    value = l1_get(key)
+    if value is not None:
+        return value
+    try:
+        cached = await ar.get(key)
+    except redis.RedisError as e:
+        print(f'Cache unavailable for {key}: {e}')
+        return None
+    return json.loads(cached) if cached is not None else None
+
+
+async def fill_shared(key: str, ttl: int, fill):
+    lock_key = f'lock:{key}'
+    try:
+        cached = await ar.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        if not await ar.set(lock_key, 1, nx=True, ex=FILL_LOCK_TTL):
+            # Another worker is filling this key, wait for its result
+            deadline = time.monotonic() + FILL_WAIT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+                cached = await ar.get(key)
+                if cached is not None:
+                    return json.loads(cached)
+                if not await ar.exists(lock_key):
+                    break
+            return await fill()
+    except redis.RedisError as e:
+        print(f'Cache unavailable for {key}: {e}')
+        return await fill()
+
+    try:
+        value = await fill()
+        if value:
+            try:
+                await ar.set(key, json.dumps(value), ex=ttl)
+            except redis.RedisError as e:
+                print(f'Error in caching {key}: {e}')
+        return value
+    finally:
+        try:
+            await ar.delete(lock_key)
+        except redis.RedisError:
+            pass
+
+
+def credentials_key(username: str, password: str) -> str:
+    # Redis key id for data that belongs to one set of credentials, never the credentials themselves
+    return hmac.new(CACHE_SECRET.encode(), f'key\0{username}\0{password}'.encode(), hashlib.sha256).hexdigest()
+
+
+def credentials_cipher(username: str, password: str) -> Fernet:
+    # Per-user data is encrypted at rest with a key only someone holding the password can derive
+    digest = hmac.new(CACHE_SECRET.encode(), f'encryption\0{username}\0{password}'.encode(), hashlib.sha256).digest()
+    return Fernet(base64.urlsafe_b64encode(digest))
+
+
+def content_hash(value) -> str:
+    # Stable hash of a JSON-serializable value, equal for equal data whatever the key order
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def snapshot_key(key: str) -> str:
+    return f'snapshot:{key}'
+
+
+async def load_snapshot(key: str, cipher: Fernet):
+    # Last stored login result for credentials key as {'result', 'hash', 'updatedAt'}, None if there is none
+    try:
+        saved = await ar.get(snapshot_key(key))
+        if saved is None:
+            return None
+        return json.loads(cipher.decrypt(saved))
+    except (redis.RedisError, InvalidToken) as e:
+        print(f'Error in loading snapshot: {e}')
+        return None
+
+
+async def save_snapshot(key: str, cipher: Fernet, result: dict):
+    snapshot = {'result': result, 'hash': content_hash(result), 'updatedAt': int(time.time())}
+    try:
+        await ar.set(snapshot_key(key), cipher.encrypt(json.dumps(snapshot).encode('utf-8')), ex=SNAPSHOT_TTL)
+    except redis.RedisError as e:
+        print(f'Error in saving snapshot: {e}')
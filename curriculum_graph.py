@@ -0,0 +1,316 @@
+import math
+import os
+
+# Prerequisite graph of a curriculum, compiled once and shared by every student on it.
+# Courses get integer ids in curriculum order and sets of courses are int bitsets, so
+# working out what a student may take is a handful of mask operations instead of
+# dict lookups per course per prerequisite. This is the one rule set main.py, app.py
+# and main_sse.py share, and the planner behind /plan
+
+GRAPH_CACHE_SIZE = int(os.environ.get('GRAPH_CACHE_SIZE', 64))  # Compiled curricula kept per process
+# Search steps a plan may spend looking for a shorter plan than the greedy one, or proving there is none
+EXACT_PLAN_STEPS = int(os.environ.get('EXACT_PLAN_STEPS', 5000))
+
+DROPPED_GRADES = ['W', 'I', 'UW']  # A current course with these grades may be taken again
+
+_graphs = {}  # curriculum key or course codes of a curriculum -> CurriculumGraph
+
+
+def skip_primary(course: dict, course_code: str) -> bool:
+    # Placeholder rows (electives, '0'), starred alternatives and the internship are never offered
+    if course_code == '0':
+        return True
+    if '#' in course_code or '*' in course_code:
+        return True
+    if course['course_name'] == 'INTERNSHIP':
+        return True
+    return False
+
+
+class SearchExhausted(Exception):
+    pass
+
+
+def bits(ids) -> int:
+    mask = 0
+    for i in ids:
+        mask |= 1 << i
+    return mask
+
+
+class CurriculumGraph:
+    def __init__(self, course_map: dict):
+        # Own copy to tell whether a later course_map is the same curriculum
+        self.source = {code: dict(course, prerequisites=list(course['prerequisites'])) for code, course in course_map.items()}
+        self.names = {code: course['course_name'] for code, course in course_map.items()}
+        self.credits = [course['credit'] for course in course_map.values()]
+        # Unlocked entry of every course, copied out for each student
+        self.entries = [unlocked_entry(course, False) for course in course_map.values()]
+        # Curriculum courses first so their ids follow curriculum order,
+        # then prerequisites that are not in the curriculum themselves
+        self.codes = list(course_map)
+        self.ids = {code: i for i, code in enumerate(self.codes)}
+        for course in course_map.values():
+            for prerequisite in course['prerequisites']:
+                if prerequisite not in self.ids:
+                    self.ids[prerequisite] = len(self.ids)
+
+        # Courses that may ever be offered
+        self.offered = bits(i for i, code in enumerate(self.codes) if not skip_primary(course_map[code], code))
+        # Prerequisite id -> courses that need it
+        self.dependents = {}
+        for i, code in enumerate(self.codes):
+            for prerequisite in course_map[code]['prerequisites']:
+                p = self.ids[prerequisite]
+                self.dependents[p] = self.dependents.get(p, 0) | (1 << i)
+
+        # Planning data, built on the first plan
+        self.height = None
+        self.descendants = None
+
+    def prepare_planning(self):
+        # Longest chain of courses each course leads to, and everything it eventually unlocks.
+        # Walked once per curriculum, in reverse topological order
+        if self.height is not None:
+            return
+        n = len(self.codes)
+        direct = [self.dependents.get(i, 0) for i in range(n)]
+        pending = [0] * n  # Dependents each course still waits for
+        for i in range(n):
+            pending[i] = bin(direct[i]).count('1')
+        order = [i for i in range(n) if pending[i] == 0]
+        height = [1] * n
+        descendants = [0] * n
+        for i in order:
+            for p in self.prerequisite_ids(i):
+                height[p] = max(height[p], height[i] + 1)
+                descendants[p] |= descendants[i] | (1 << i)
+                pending[p] -= 1
+                if pending[p] == 0:
+                    order.append(p)
+        # Courses on a prerequisite cycle never leave pending and keep height 1
+        self.height = height
+        self.descendants = descendants
+
+    def prerequisite_ids(self, i: int):
+        # Ids of the prerequisites of course i that are in the curriculum themselves
+        return {self.ids[prerequisite] for prerequisite in self.source[self.codes[i]]['prerequisites'] if self.ids[prerequisite] < len(self.codes)}
+
+    def blocked(self, passed: int) -> int:
+        # Every course that needs a prerequisite not in passed, in one pass over the prerequisites
+        blocked = 0
+        for p, dependents in self.dependents.items():
+            if not passed >> p & 1:
+                blocked |= dependents
+        return blocked
+
+    def mask(self, codes) -> int:
+        return bits(self.ids[code] for code in codes if code in self.ids)
+
+    def unlocked(self, completed_courses: dict, current_semester_courses: dict, pre_registered_courses: dict) -> int:
+        completed = self.mask(completed_courses)
+        # Any current course counts towards prerequisites, whatever its grade
+        passed = completed | self.mask(current_semester_courses)
+        # A current course blocks itself unless it was dropped
+        taking = self.mask(
+            code for code, course in current_semester_courses.items()
+            if self.names.get(code) == course['course_name'] and course['grade'] not in DROPPED_GRADES
+        )
+
+        # Pre-registered courses are offered even if the portal let the student past a prerequisite
+        return self.offered & ~completed & ~taking & (~self.blocked(passed) | self.mask(pre_registered_courses))
+
+    def plan(self, passed: int, credit_cap: int):
+        # Semesters of course ids, longest chains first, each within credit_cap, and the courses
+        # that can't be planned because a prerequisite is outside the curriculum or on a cycle
+        self.prepare_planning()
+        remaining = self.offered & ~passed
+        semesters = []
+        while remaining:
+            ready = sorted(self.courses(remaining & ~self.blocked(passed)), key=lambda i: -self.height[i])
+            if not ready:
+                break
+            semester = []
+            credit = 0
+            for i in ready:
+                if credit + self.credits[i] <= credit_cap or not semester:
+                    semester.append(i)
+                    credit += self.credits[i]
+            taken = bits(semester)
+            passed |= taken
+            remaining &= ~taken
+            semesters.append(semester)
+        return semesters, remaining
+
+    def shortest_plan(self, passed: int, credit_cap: int, semesters: list, unplannable: int):
+        # Fewest semesters for the courses plan() placed, searching depth first from the lower bound up to
+        # the greedy plan. None if that takes more than EXACT_PLAN_STEPS steps.
+        # Taking a ready course earlier never delays another, so only semesters with no room left are tried
+        self.prepare_planning()
+        failed = set()  # (courses left, semesters) with no plan
+        steps = 0
+
+        def step():
+            nonlocal steps
+            steps += 1
+            if steps > EXACT_PLAN_STEPS:
+                raise SearchExhausted()
+
+        def search(passed: int, left: int, depth: int):
+            if not left:
+                return []
+            if depth == 0 or (left, depth) in failed or self.lower_bound(passed, credit_cap) > depth:
+                return None
+            step()
+            ready = sorted(self.courses(left & ~self.blocked(passed)), key=lambda i: -self.height[i])
+            for semester in self.full_semesters(ready, credit_cap, step):
+                taken = bits(semester)
+                rest = search(passed | taken, left & ~taken, depth - 1)
+                if rest is not None:
+                    return [semester] + rest
+            failed.add((left, depth))
+            return None
+
+        target = self.offered & ~passed & ~unplannable
+        try:
+            for depth in range(self.lower_bound(passed, credit_cap), len(semesters)):
+                shorter = search(passed, target, depth)
+                if shorter is not None:
+                    return shorter
+        except SearchExhausted:
+            return None
+        return semesters
+
+    def full_semesters(self, ready: list, credit_cap: int, step):
+        # Every set of ready courses within credit_cap with no room for another one of them.
+        # A course over the cap fills a semester on its own, as in plan(). step() is called per choice
+        credits = [min(self.credits[i], credit_cap) for i in ready]
+        chosen = []
+
+        def pick(k: int, room: int, smallest_skipped: int):
+            step()
+            if k == len(ready):
+                if smallest_skipped > room:
+                    yield list(chosen)
+                return
+            if credits[k] <= room:
+                chosen.append(ready[k])
+                yield from pick(k + 1, room - credits[k], smallest_skipped)
+                chosen.pop()
+            yield from pick(k + 1, room, min(smallest_skipped, credits[k]))
+
+        return pick(0, credit_cap, math.inf)
+
+    def lower_bound(self, passed: int, credit_cap: int) -> int:
+        # No plan is shorter than the longest chain left or the credits left over the cap
+        remaining = self.offered & ~passed
+        credit = 0
+        chain = 0
+        while remaining:
+            ready = remaining & ~self.blocked(passed)
+            if not ready:
+                break
+            credit += sum(min(self.credits[i], credit_cap) for i in self.courses(ready))
+            passed |= ready
+            remaining &= ~ready
+            chain += 1
+        return max(chain, math.ceil(credit / credit_cap))
+
+    def courses(self, mask: int):
+        # Ids of the curriculum courses in mask, in curriculum order
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+
+def compile_graph(course_map: dict, key: str | None = None) -> CurriculumGraph:
+    # Students on the same curriculum share one graph. Looked up by key, the server's name for the
+    # curriculum, or else by the course codes, and confirmed with a full comparison, both of which
+    # run in C unlike building a structural key
+    if key is None:
+        key = tuple(course_map)
+    graph = _graphs.get(key)
+    if graph is None or graph.source != course_map:
+        graph = CurriculumGraph(course_map)
+        _graphs.pop(key, None)
+        if len(_graphs) >= GRAPH_CACHE_SIZE:
+            _graphs.pop(next(iter(_graphs)))
+        _graphs[key] = graph
+    return graph
+
+
+def cached_graph(key: str):
+    # Graph compiled under key, None if this process hasn't got it
+    graph = _graphs.get(key)
+    if graph is not None:
+        # Recently used, evicted last
+        _graphs[key] = _graphs.pop(key)
+    return graph
+
+
+def unlocked_entry(course: dict, retake: bool) -> dict:
+    return {'course_name': course['course_name'], 'credit': course['credit'], 'prerequisites': course['prerequisites'], 'retake': retake}
+
+
+def add_credits(completed_courses: dict, course_map: dict):
+    # Completed courses get their credit from the curriculum, offered or not
+    for course_code, course in completed_courses.items():
+        if course_code in course_map:
+            course['credit'] = course_map[course_code]['credit']
+
+
+def unlocked_courses(course_map: dict, completed_courses: dict, current_semester_courses: dict, pre_registered_courses: dict, key: str | None = None) -> dict:
+    # Courses the student may take next: D grades to retake first, then the rest in curriculum order.
+    # key names the curriculum for compile_graph
+    unlocked = {}
+    for course_code, course in completed_courses.items():
+        if course['grade'] == 'D' and course_code in course_map:
+            unlocked[course_code] = unlocked_entry(dict(course_map[course_code], course_name=course['course_name']), True)
+
+    graph = compile_graph(course_map, key)
+    for i in graph.courses(graph.unlocked(completed_courses, current_semester_courses, pre_registered_courses)):
+        unlocked[graph.codes[i]] = dict(graph.entries[i])
+    return unlocked
+
+
+def passed_mask(graph: CurriculumGraph, completed: list, current: list) -> int:
+    # Current courses count as passed, plans start next semester
+    return graph.mask(completed) | graph.mask(current)
+
+
+def plan_degree(graph: CurriculumGraph, completed: list, current: list, credit_cap: int) -> dict:
+    passed = passed_mask(graph, completed, current)
+    semesters, unplannable = graph.plan(passed, credit_cap)
+    lower_bound = graph.lower_bound(passed, credit_cap)
+    # The greedy plan is the shortest if it meets the lower bound, else a search finds the shortest
+    # one while the curriculum is small enough. Otherwise it is only an upper bound
+    optimal = len(semesters) == lower_bound
+    if not optimal:
+        shortest = graph.shortest_plan(passed, credit_cap, semesters, unplannable)
+        if shortest is not None:
+            semesters = shortest
+            optimal = True
+    return {
+        'semesters': len(semesters),
+        'optimal': optimal,
+        'lowerBound': lower_bound,
+        'plan': [{'courses': [graph.codes[i] for i in semester], 'credit': sum(graph.credits[i] for i in semester)} for semester in semesters],
+        'unplannable': [graph.codes[i] for i in graph.courses(unplannable)],
+    }
+
+
+def unlocks_after(graph: CurriculumGraph, completed: list, current: list, course_code: str) -> dict:
+    # Courses that become available right after passing course_code, and all courses that need it eventually.
+    # course_code must be in the curriculum
+    graph.prepare_planning()
+    passed = passed_mask(graph, completed, current)
+    i = graph.ids[course_code]
+    remaining = graph.offered & ~passed & ~(1 << i)
+    before = remaining & ~graph.blocked(passed)
+    after = remaining & ~graph.blocked(passed | (1 << i))
+    return {
+        'course': course_code,
+        'now': [graph.codes[j] for j in graph.courses(after & ~before)],
+        'eventually': [graph.codes[j] for j in graph.courses(graph.descendants[i] & remaining)],
+    }
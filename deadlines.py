@@ -0,0 +1,117 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import aiohttp
+
+# Timeouts for everything that talks to the portal. A login gets an end-to-end deadline,
+# each stage of it a share of that, and every portal request only the time its stage has left
+
+# Seconds to connect to the portal, and to wait for more of a response once connected
+PORTAL_CONNECT_TIMEOUT = float(os.environ.get('PORTAL_CONNECT_TIMEOUT', 5))
+PORTAL_READ_TIMEOUT = float(os.environ.get('PORTAL_READ_TIMEOUT', 30))
+
+# Seconds a login may take from being admitted to its last portal request
+LOGIN_DEADLINE = float(os.environ.get('LOGIN_DEADLINE', 90))
+
+# Most of the deadline a stage may use. Time an early stage doesn't use is left for the later ones,
+# the deadline itself still caps them all
+STAGE_BUDGETS = {'login': 0.3, 'curriculum': 0.3, 'grades': 0.25, 'semesters': 0.6}
+
+# What the user is told the portal was doing when it ran out of time
+STAGE_NAMES = {'login': 'logging in', 'curriculum': 'getting the curriculum', 'grades': 'getting the grade report', 'semesters': 'getting class routines'}
+
+
+class StageTimeout(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f'Timed out while {STAGE_NAMES[stage]}' if stage in STAGE_NAMES else 'Timed out')
+        self.stage = stage
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.end = time.monotonic() + seconds
+        self.stage_name = None
+        self.stage_end = self.end
+        self.stage_starts = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        # A stage can be entered more than once, its budget counts from the first time
+        start = self.stage_starts.setdefault(name, time.monotonic())
+        self.stage_name = name
+        self.stage_end = min(self.end, start + self.seconds * STAGE_BUDGETS[name])
+        try:
+            yield
+        finally:
+            self.stage_name = None
+            self.stage_end = self.end
+
+    def remaining(self) -> float:
+        return self.stage_end - time.monotonic()
+
+    def stage_remaining(self, name: str) -> float:
+        # Seconds left of the stage name, for stages that run at the same time in threads.
+        # Its budget counts from the first call, like stage()
+        start = self.stage_starts.setdefault(name, time.monotonic())
+        return min(self.end, start + self.seconds * STAGE_BUDGETS[name]) - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise StageTimeout(self.stage_name)
+
+    async def run(self, awaitable):
+        # Result of awaitable, cancelled with everything it started if the stage runs out of time.
+        # A timeout of its own, like a socket read timing out, is raised as it is
+        self.check()
+        try:
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except asyncio.TimeoutError:
+            if self.expired():
+                raise StageTimeout(self.stage_name)
+            raise
+
+    async def run_stage(self, name: str, awaitable):
+        # run() for stages that run at the same time, bounded by stage_remaining(name)
+        remaining = self.stage_remaining(name)
+        if remaining <= 0:
+            raise StageTimeout(name)
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError:
+            if self.stage_remaining(name) <= 0:
+                raise StageTimeout(name)
+            raise
+
+
+# Deadline of the login the current task works for. request_timeout() and check_expired() read it,
+# so the portal helpers need no deadline argument
+current_deadline = ContextVar('current_deadline', default=None)
+
+
+def start_deadline(seconds: float = LOGIN_DEADLINE) -> Deadline:
+    deadline = Deadline(seconds)
+    current_deadline.set(deadline)
+    return deadline
+
+
+def request_timeout() -> aiohttp.ClientTimeout:
+    # Timeout for one portal request, bounded by what is left of the current stage
+    total = None
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.check()
+        total = deadline.remaining()
+    return aiohttp.ClientTimeout(total=total, connect=PORTAL_CONNECT_TIMEOUT, sock_read=PORTAL_READ_TIMEOUT)
+
+
+def check_expired():
+    # Raises StageTimeout if a failed request failed because the current stage ran out of time
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.check()
@@ -0,0 +1,46 @@
+import json
+import os
+import zlib
+
+# Serialization of the /login event stream
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Gzip the event stream for clients that accept it
+SSE_COMPRESSION = os.environ.get('SSE_COMPRESSION', '1') in ['1', 'true']
+SSE_COMPRESSION_LEVEL = int(os.environ.get('SSE_COMPRESSION_LEVEL', 6))
+
+
+def dumps(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def format_event(payload: dict, event_id: str | None = None) -> bytes:
+    # Events with an id let the client resume after them, see jobs.py
+    if event_id is None:
+        return b'data: ' + dumps(payload) + b'\n\n'
+    return b'id: ' + event_id.encode('ascii') + b'\ndata: ' + dumps(payload) + b'\n\n'
+
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    if not SSE_COMPRESSION or not accept_encoding:
+        return False
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() == 'gzip':
+            return params.replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']
+    return False
+
+
+async def gzip_stream(lines):
+    # One gzip member over the whole stream, flushed after every event so the client
+    # can decode it as soon as it arrives
+    compressor = zlib.compressobj(SSE_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    async for line in lines:
+        yield compressor.compress(line) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
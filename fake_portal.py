@@ -0,0 +1,110 @@
+# Local stand-in for portal.aiub.edu, serving scrubbed pages from fixtures/
+# Usage: python fake_portal.py --port 8001 --latency 0.2 --jitter 0.1 --error-rate 0.05 --mode normal
+# Then start the API with AIUB_PORTAL_URL=http://127.0.0.1:8001 to run the real pipeline against it
+
+import argparse
+import asyncio
+import os
+import random
+import secrets
+import threading
+
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# normal: every login succeeds, captcha: the login page asks for a captcha,
+# tpe: logins land on the pending evaluation page, invalid: every login is rejected
+MODES = ['normal', 'captcha', 'tpe', 'invalid']
+
+SESSION_COOKIE = 'ASP.NET_SessionId'
+
+
+def load_fixture(name: str) -> str:
+    # newline='' keeps the \r\n line breaks the real pages are served with
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def create_app(latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, mode: str = 'normal') -> web.Application:
+    pages = {name: load_fixture(name) for name in os.listdir(FIXTURES_DIR)}
+    sessions = set()
+
+    def html(text: str, status: int = 200):
+        return web.Response(text=text, status=status, content_type='text/html')
+
+    @web.middleware
+    async def portal_conditions(request, handler):
+        # Every request pays the configured latency and may hit a server error
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        if random.random() < error_rate:
+            return html('<h1>Service Unavailable</h1>', status=503)
+        return await handler(request)
+
+    def page(name: str):
+        async def handler(request):
+            # Pages behind the login bounce to the login page like the portal does
+            if request.cookies.get(SESSION_COOKIE) not in sessions:
+                raise web.HTTPFound('/')
+            if '{}' in name:
+                return html(pages.get(name.format(request.query.get('ID')), pages['curriculum_empty.html']))
+            return html(pages[name])
+        return handler
+
+    async def login_page(request):
+        return html(pages['login.html'])
+
+    async def login(request):
+        form = await request.post()
+        if mode == 'captcha':
+            return html(pages['login.html'].replace('style="display: none"', 'style="display: block"'))
+        if mode == 'invalid' or not form.get('UserName') or form.get('Password') == 'wrong':
+            return html(pages['login.html'])
+
+        session_id = secrets.token_hex(12)
+        sessions.add(session_id)
+        response = web.HTTPFound('/Student/Tpe/Start' if mode == 'tpe' else '/Student')
+        response.set_cookie(SESSION_COOKIE, session_id)
+        raise response
+
+    app = web.Application(middlewares=[portal_conditions])
+    app.router.add_get('/', login_page)
+    app.router.add_post('/', login)
+    app.router.add_get('/Student', page('student.html'))
+    app.router.add_get('/Student/Tpe/Start', page('tpe.html'))
+    app.router.add_get('/Student/Curriculum', page('curriculum.html'))
+    app.router.add_get('/Common/Curriculum', page('curriculum_{}.html'))
+    app.router.add_get('/Student/GradeReport/ByCurriculum', page('grade_report.html'))
+    app.router.add_get('/Student/Registration', page('registration.html'))
+    return app
+
+
+def start_in_thread(**options) -> str:
+    # Serve on a random port from a background thread and return the base url.
+    # The portal gets its own loop so a blocked client loop can't stall it
+    started = threading.Event()
+    address = {}
+
+    async def serve():
+        runner = web.AppRunner(create_app(**options))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        address['url'] = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        started.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    started.wait()
+    return address['url']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for portal.aiub.edu')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds around the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 503')
+    parser.add_argument('--mode', choices=MODES, default='normal')
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency, args.jitter, args.error_rate, args.mode), host=args.host, port=args.port)
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+import aiohttp
+import redis
+
+import cache
+import deadlines
+import jobs
+import metrics
+import signals
+
+# Outbound concurrency governor for the portal. Every portal request takes a slot. The number
+# of slots adapts AIMD-style: it grows by about one per window of fast, successful requests
+# and halves when the portal answers slowly, with a 5xx or not at all. Slots are also counted
+# across the cluster in Redis. Logins are admitted in order while there are enough slots for
+# them, waiting ones are told their position in the queue
+
+PORTAL_CONCURRENCY = float(os.environ.get('PORTAL_CONCURRENCY', 64))  # Starting limit per worker
+PORTAL_MIN_CONCURRENCY = float(os.environ.get('PORTAL_MIN_CONCURRENCY', 2))
+PORTAL_MAX_CONCURRENCY = float(os.environ.get('PORTAL_MAX_CONCURRENCY', 256))
+# In-flight portal requests across all workers, 0 turns the Redis coordination off
+PORTAL_CLUSTER_CONCURRENCY = int(os.environ.get('PORTAL_CLUSTER_CONCURRENCY', 512))
+# Seconds a portal response may take before it counts as the portal being overloaded
+PORTAL_LATENCY_TARGET = float(os.environ.get('PORTAL_LATENCY_TARGET', 3))
+# Slots a login uses at once, so a login is only admitted if it can make progress
+PORTAL_REQUESTS_PER_LOGIN = int(os.environ.get('PORTAL_REQUESTS_PER_LOGIN', 4))
+
+DECREASE_INTERVAL = 1  # Seconds between two halvings, one overload is felt by many requests at once
+CLUSTER_SLOT_TTL = 60  # Seconds before the cluster slot of a crashed worker is freed
+CLUSTER_RETRY = 0.05  # Seconds between attempts to take a cluster slot
+CLUSTER_WAIT = 10  # Seconds we wait for a cluster slot before going anyway
+CLUSTER_BACKOFF = 30  # Seconds we go without the cluster count after a Redis error
+CLUSTER_KEY = 'portal:in-flight'
+
+
+class Call:
+    # One portal request, the caller sets status once the response arrives
+    def __init__(self):
+        self.status = None
+        self.timeout = None  # aiohttp.ClientTimeout the request has to keep to
+
+
+class Governor:
+    def __init__(self):
+        self.limit = PORTAL_CONCURRENCY
+        self.in_flight = 0
+        self.waiters = deque()  # Futures of requests waiting for a slot
+        self.logins = 0  # Admitted logins still running
+        self.queue = []  # Tickets of logins waiting to be admitted, first in line first
+        self.changed = signals.Broadcast()  # Notified when the limit, the queue or the running logins change
+        self.last_decrease = 0.0
+        self.cluster_down_until = 0.0
+        metrics.PORTAL_LIMIT.set(self.limit)
+
+    def login_capacity(self) -> int:
+        return max(1, int(self.limit // PORTAL_REQUESTS_PER_LOGIN))
+
+    async def admit(self):
+        # Yields the 1-based queue position of this login whenever it changes, returns once admitted
+        ticket = object()
+        self.queue.append(ticket)
+        metrics.LOGINS_QUEUED.set(len(self.queue))
+        position = None
+        try:
+            while True:
+                if self.queue[0] is ticket and self.logins < self.login_capacity():
+                    self.queue.pop(0)
+                    self.logins += 1
+                    self.changed.notify()
+                    return
+                if self.queue.index(ticket) + 1 != position:
+                    position = self.queue.index(ticket) + 1
+                    yield position
+                await self.changed.wait()
+        finally:
+            if ticket in self.queue:
+                # The client went away while waiting
+                self.queue.remove(ticket)
+                self.changed.notify()
+            metrics.LOGINS_QUEUED.set(len(self.queue))
+
+    def leave(self):
+        # An admitted login finished
+        self.logins -= 1
+        self.changed.notify()
+
+    @asynccontextmanager
+    async def request(self):
+        await self.acquire()
+        try:
+            member = await self.acquire_cluster()
+        except BaseException:
+            self.release()
+            raise
+        call = Call()
+        start = time.monotonic()
+        healthy = None  # Stays None if the request was cancelled or failed on our side, that says nothing about the portal
+        try:
+            yield call
+            healthy = (call.status is None or call.status < 500) and time.monotonic() - start <= PORTAL_LATENCY_TARGET
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+            raise
+        except asyncio.CancelledError:
+            metrics.ABANDONED_REQUESTS.labels(cancel_cause()).inc()
+            raise
+        finally:
+            if healthy is not None:
+                self.adjust(not healthy)
+            await self.release_cluster(member)
+            self.release()
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                # release() hands its slot over, in_flight is already counted for us
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                elif not waiter.cancelled():
+                    self.release()
+                raise
+        metrics.PORTAL_IN_FLIGHT.set(self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+        metrics.PORTAL_IN_FLIGHT.set(self.in_flight)
+
+    def wake(self):
+        # Hand free slots to waiting requests, first come first served
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def adjust(self, overloaded: bool):
+        capacity = self.login_capacity()
+        if overloaded:
+            now = time.monotonic()
+            if now - self.last_decrease < DECREASE_INTERVAL:
+                return
+            self.last_decrease = now
+            self.limit = max(PORTAL_MIN_CONCURRENCY, self.limit / 2)
+            print(f'Portal overloaded, limiting to {int(self.limit)} requests at once')
+        else:
+            self.limit = min(PORTAL_MAX_CONCURRENCY, self.limit + 1 / self.limit)
+            self.wake()
+        metrics.PORTAL_LIMIT.set(self.limit)
+        if self.login_capacity() != capacity:
+            # Queued logins may move
+            self.changed.notify()
+
+    async def acquire_cluster(self):
+        # Member of our slot in the cluster-wide set, None if we go without one
+        if PORTAL_CLUSTER_CONCURRENCY <= 0 or time.monotonic() < self.cluster_down_until:
+            return None
+        member = uuid.uuid4().hex
+        deadline = time.monotonic() + CLUSTER_WAIT
+        try:
+            while True:
+                now = time.time()
+                async with cache.ar.pipeline(transaction=True) as pipe:
+                    pipe.zremrangebyscore(CLUSTER_KEY, 0, now)
+                    pipe.zadd(CLUSTER_KEY, {member: now + CLUSTER_SLOT_TTL})
+                    pipe.zcard(CLUSTER_KEY)
+                    _, _, count = await pipe.execute()
+                if count <= PORTAL_CLUSTER_CONCURRENCY:
+                    return member
+                await cache.ar.zrem(CLUSTER_KEY, member)
+                if time.monotonic() > deadline:
+                    return None
+                await asyncio.sleep(CLUSTER_RETRY)
+        except redis.RedisError as e:
+            print(f'Error in taking cluster portal slot, going without for {CLUSTER_BACKOFF} seconds: {e}')
+            self.cluster_down_until = time.monotonic() + CLUSTER_BACKOFF
+            return None
+
+    async def release_cluster(self, member):
+        if member is None:
+            return
+        try:
+            await cache.ar.zrem(CLUSTER_KEY, member)
+        except redis.RedisError as e:
+            print(f'Error in releasing cluster portal slot: {e}')
+
+
+def cancel_cause() -> str:
+    # Why the request the current task was making got cancelled
+    job = jobs.current_job.get()
+    if job is not None and job.cancelled:
+        return 'disconnect'  # Every client of the login left
+    deadline = deadlines.current_deadline.get()
+    if deadline is not None and deadline.expired():
+        return 'timeout'  # Its stage ran out of time
+    return 'other'
+
+
+_governor = None
+
+
+def get_governor() -> Governor:
+    # Created on first use, asyncio primitives belong to the running loop
+    global _governor
+    if _governor is None:
+        _governor = Governor()
+    return _governor
@@ -0,0 +1,326 @@
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from contextvars import ContextVar
+import redis
+from cryptography.fernet import Fernet, InvalidToken
+
+import cache
+import signals
+
+# Single-flight logins: requests with the same credentials share one portal scrape.
+# Within a worker every request follows the same Job. Across workers the first one to claim
+# the credentials runs the scrape and appends its events to a Redis stream, the other
+# workers relay that stream to their own subscribers. When every subscriber of a login has
+# gone away, here and on the workers relaying it, the scrape is cancelled.
+# Every event has an id, <job id>.<index>. A client that reconnects with the last id it got
+# continues the same login after that event instead of starting a new one
+
+JOB_LOCK_TTL = int(os.environ.get('JOB_LOCK_TTL', 120))  # Seconds a worker may go silent before its claim expires
+# Seconds the events of a finished job are kept for slow followers and reconnecting clients
+JOB_LOG_TTL = int(os.environ.get('JOB_LOG_TTL', 60))
+# Seconds a login keeps running after its last client left, for the client to reconnect
+DISCONNECT_GRACE = float(os.environ.get('DISCONNECT_GRACE', 10))
+FOLLOW_BLOCK_MS = 500  # Kept below the Redis socket timeout
+
+_jobs = {}  # credentials key -> Job running or relayed by this worker
+_streams = {}  # job id -> Job running, recently finished or cancelled, for clients resuming it
+
+# Job the current task works for, set by run_job. governor.cancel_cause() reads it to tell
+# requests cancelled because every client left from other cancellations
+current_job = ContextVar('current_job', default=None)
+
+
+class Job:
+    def __init__(self, key: str):
+        self.key = key
+        self.id = uuid.uuid4().hex
+        self.events = []
+        self.offset = 0  # Index of events[0], the ones before were dropped when the job finished
+        self.done = False
+        self.shared = False  # True when this worker runs the scrape for the whole cluster
+        self.updated = signals.Broadcast()  # Notified on every new event and when the job ends
+        self.task = None
+        self.subscribers = 0  # Open streams on this worker following the job
+        self.left_at = 0.0  # When the last subscriber left
+        self.cancelled = False
+        self.reaper = None  # Task cancelling the job if nobody comes back within the grace period
+
+    def publish(self, payload: dict):
+        self.events.append(payload)
+        self.updated.notify()
+
+    def close(self):
+        self.done = True
+        # Only the final event is kept for the rest of JOB_LOG_TTL, it carries the whole result
+        self.offset += max(0, len(self.events) - 1)
+        self.events = self.events[-1:]
+        self.updated.notify()
+
+    async def follow(self, index: int = 0):
+        # Index and payload of every event from index on, including those published before we joined,
+        # and whether events were dropped before we got them
+        while True:
+            dropped = index < self.offset
+            index = max(index, self.offset)
+            while index - self.offset < len(self.events):
+                yield index, self.events[index - self.offset], dropped
+                index += 1
+            if self.done:
+                return
+            await self.updated.wait()
+
+
+def lock_key(key: str) -> str:
+    return f'login:{key}'
+
+
+def events_key(job_id: str) -> str:
+    return f'login:events:{job_id}'
+
+
+def followers_key(job_id: str) -> str:
+    # Number of workers relaying the job
+    return f'login:followers:{job_id}'
+
+
+def event_id(job: Job, index: int) -> str:
+    return f'{job.id}.{index}'
+
+
+def parse_event_id(last_event_id: str | None):
+    # Job id and index of the event, None if it isn't one of ours
+    match = re.fullmatch(r'([0-9a-f]{32})\.(\d+)', last_event_id or '')
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+async def subscribe(key: str, cipher: Fernet, start, last_event_id: str | None = None):
+    # Yields the event id and payload of every event of the login for key, and whether earlier events were
+    # dropped before this subscriber got them. start() returns the scrape's payload generator and is only
+    # called if no other request for key is in flight anywhere in the cluster.
+    # With the id of an event the client already got, the login it belongs to continues after that event
+    job, index = None, 0
+    resumed = parse_event_id(last_event_id)
+    if resumed is not None:
+        job = await resume(key, cipher, resumed[0])
+        if job is not None:
+            index = resumed[1] + 1
+    if job is None:
+        job = _jobs.get(key)
+        if job is None or job.done:
+            job = Job(key)
+            _jobs[key] = job
+            _streams[job.id] = job
+            job.task = asyncio.create_task(run_job(job, cipher, start))
+
+    job.subscribers += 1
+    try:
+        async for index, payload, dropped in job.follow(index):
+            yield event_id(job, index), payload, dropped
+    finally:
+        job.subscribers -= 1
+        if job.subscribers == 0 and not job.done:
+            job.left_at = time.monotonic()
+            # The loop only keeps weak references to tasks, so the job holds on to its reaper until it finishes
+            if job.reaper is not None:
+                job.reaper.cancel()
+            job.reaper = asyncio.create_task(cancel_if_unfollowed(job))
+            job.reaper.add_done_callback(lambda task: reaped(job, task))
+
+
+async def resume(key: str, cipher: Fernet, job_id: str):
+    # Job to continue for a reconnecting client, None if the login isn't around any more
+    job = _streams.get(job_id)
+    if job is not None:
+        return job if job.key == key and not job.cancelled else None
+    try:
+        # Run or relayed by another worker, we relay its log from the start
+        first = await cache.ar.xrange(events_key(job_id), count=1)
+        last = await cache.ar.xrevrange(events_key(job_id), count=1)
+        if not first or b'cancelled' in last[0][1]:
+            return None
+        # Only the client that started the login can decrypt its events
+        cipher.decrypt(first[0][1][b'payload'])
+    except (redis.RedisError, InvalidToken, KeyError) as e:
+        print(f'Error in resuming login: {e}')
+        return None
+    print(f'Resuming login of another worker: {job_id}')
+    job = Job(key)
+    job.id = job_id
+    _streams[job_id] = job
+    if _jobs.get(key) is None:
+        _jobs[key] = job
+    job.task = asyncio.create_task(run_job(job, cipher, None, job_id))
+    return job
+
+
+def cancel(job: Job):
+    if job.cancelled or job.done:
+        return
+    print('Every client left, cancelling login')
+    # New requests for the same credentials start over instead of joining or resuming a cancelled job
+    if _jobs.get(job.key) is job:
+        del _jobs[job.key]
+    job.cancelled = True
+    job.task.cancel()
+
+
+def abandoned(job: Job) -> bool:
+    # No client here has wanted the job for the whole grace period
+    return job.subscribers == 0 and time.monotonic() - job.left_at >= DISCONNECT_GRACE
+
+
+async def cancel_if_unfollowed(job: Job):
+    await asyncio.sleep(DISCONNECT_GRACE)
+    if not abandoned(job) or job.done:
+        return
+    followers = 0
+    if job.shared:
+        # Workers relaying the job may still want it
+        try:
+            followers = int(await cache.ar.get(followers_key(job.id)) or 0)
+        except redis.RedisError as e:
+            print(f'Error in counting login followers: {e}')
+    if followers == 0 and abandoned(job):
+        cancel(job)
+
+
+def reaped(job: Job, task: asyncio.Task):
+    if job.reaper is task:
+        job.reaper = None
+
+
+def forget(job: Job):
+    if _streams.get(job.id) is job:
+        del _streams[job.id]
+
+
+async def run_job(job: Job, cipher: Fernet, start, remote_id: str | None = None):
+    # Runs the scrape, or relays the job remote_id of another worker
+    current_job.set(job)
+    source = None
+    try:
+        if remote_id is None:
+            remote_id = await claim(job)
+        if remote_id is not None:
+            print(f'Following login running on another worker: {remote_id}')
+            # Event ids stay those of the job we relay, so clients can resume on any worker
+            forget(job)
+            job.id = remote_id
+            _streams[job.id] = job
+            source = follow_remote(remote_id, cipher)
+        else:
+            source = start()
+
+        async for payload in source:
+            if job.cancelled:
+                # The cancellation got lost, e.g. in a wait_for that finished at the same moment
+                break
+            job.publish(payload)
+            if job.shared:
+                await share(job, cipher, payload)
+
+    except Exception as e:
+        print('Error in login job:', e)
+        job.publish({'status': 'error', 'message': str(e)})
+
+    finally:
+        if job.shared:
+            # Before anyone hears the job ended, so a new login for the same credentials doesn't find our claim
+            await release(job)
+        job.close()
+        if job.reaper is not None:
+            job.reaper.cancel()
+        if _jobs.get(job.key) is job:
+            del _jobs[job.key]
+        # Reconnecting clients can still get the rest of the events for a while
+        asyncio.get_running_loop().call_later(JOB_LOG_TTL, forget, job)
+        if source is not None:
+            # Stops the scrape if we were cancelled between two of its events
+            await source.aclose()
+
+
+async def claim(job: Job):
+    # None when this worker should run the scrape itself, else the id of the job to follow
+    try:
+        if await cache.ar.set(lock_key(job.key), job.id, nx=True, ex=JOB_LOCK_TTL):
+            job.shared = True
+            return None
+        remote_id = await cache.ar.get(lock_key(job.key))
+        if remote_id is None:
+            # The claim expired between the two calls, we run it ourselves unshared
+            return None
+        remote_id = remote_id.decode('utf-8')
+        ended = _streams.get(remote_id)
+        if ended is not None and ended.shared and (ended.done or ended.cancelled):
+            # Our own cancelled or finished job that hasn't let go of the claim yet, it won't send anything more.
+            # Its release() leaves the claim alone once it names us
+            await cache.ar.set(lock_key(job.key), job.id, ex=JOB_LOCK_TTL)
+            job.shared = True
+            return None
+        return remote_id
+    except redis.RedisError as e:
+        print(f'Error in claiming login, running it unshared: {e}')
+        return None
+
+
+async def share(job: Job, cipher: Fernet, payload: dict):
+    try:
+        await cache.ar.xadd(events_key(job.id), {'payload': cipher.encrypt(json.dumps(payload).encode('utf-8'))})
+        await cache.ar.expire(lock_key(job.key), JOB_LOCK_TTL)
+        if abandoned(job) and not int(await cache.ar.get(followers_key(job.id)) or 0):
+            # Our own clients left earlier and the last relaying worker just did
+            cancel(job)
+    except redis.RedisError as e:
+        # Followers on other workers time out and report the error, local subscribers are unaffected
+        print(f'Error in sharing login events: {e}')
+        job.shared = False
+
+
+async def release(job: Job):
+    try:
+        # Followers that join a cancelled job report it instead of a result
+        await cache.ar.xadd(events_key(job.id), {'end': 1, 'cancelled': 1} if job.cancelled else {'end': 1})
+        await cache.ar.expire(events_key(job.id), JOB_LOG_TTL)
+        if await cache.ar.get(lock_key(job.key)) == job.id.encode('utf-8'):
+            await cache.ar.delete(lock_key(job.key))
+    except redis.RedisError as e:
+        print(f'Error in releasing login: {e}')
+
+
+async def follow_remote(job_id: str, cipher: Fernet):
+    await cache.ar.incr(followers_key(job_id))
+    await cache.ar.expire(followers_key(job_id), JOB_LOCK_TTL)
+    try:
+        async for payload in read_remote(job_id, cipher):
+            yield payload
+    finally:
+        try:
+            await cache.ar.decr(followers_key(job_id))
+        except redis.RedisError as e:
+            print(f'Error in leaving login: {e}')
+
+
+async def read_remote(job_id: str, cipher: Fernet):
+    last_id = '0'
+    deadline = time.monotonic() + JOB_LOCK_TTL
+    while True:
+        entries = await cache.ar.xread({events_key(job_id): last_id}, count=100, block=FOLLOW_BLOCK_MS)
+        if not entries:
+            if time.monotonic() > deadline:
+                raise RuntimeError('Login on another worker stopped responding. Try again')
+            continue
+        deadline = time.monotonic() + JOB_LOCK_TTL
+        for _, messages in entries:
+            for message_id, fields in messages:
+                last_id = message_id
+                if b'end' in fields:
+                    if b'cancelled' in fields:
+                        raise RuntimeError('Login was interrupted. Try again')
+                    return
+                yield json.loads(cipher.decrypt(fields[b'payload']))
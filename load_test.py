@@ -0,0 +1,119 @@
+# Load generator for the /login endpoint
+# Opens many concurrent logins against a running server and reports latency percentiles as JSON.
+# Usage:
+#   python fake_portal.py --latency 0.1 --jitter 0.05
+#   AIUB_PORTAL_URL=http://127.0.0.1:8001 uvicorn main_sse:app --port 8000
+#   python load_test.py http://127.0.0.1:8000 --concurrency 50 --requests 200 --label main_sse
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+# sse: main_sse.py streams GET /login, form: main.py and app.py answer POST / with JSON
+VARIANTS = ['sse', 'form']
+
+
+def percentile(values: list, p: float):
+    # Nearest-rank percentile, None when there is nothing to rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, round(p / 100 * len(ordered)))
+    return round(ordered[min(rank, len(ordered)) - 1], 4)
+
+
+def summarize(values: list) -> dict:
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99), 'max': round(max(values), 4) if values else None}
+
+
+async def sse_login(session: aiohttp.ClientSession, target: str, username: str, password: str) -> dict:
+    start = time.perf_counter()
+    first_event = None
+    async with session.get(f'{target}/login', params={'username': username, 'password': password}) as response:
+        if response.status != 200:
+            return {'ok': False, 'error': f'HTTP {response.status}', 'first_event_s': None, 'complete_s': time.perf_counter() - start}
+        async for line in response.content:
+            line = line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            if first_event is None:
+                first_event = time.perf_counter() - start
+            event = json.loads(line[len('data:'):])
+            if event.get('status') == 'complete':
+                return {'ok': True, 'first_event_s': first_event, 'complete_s': time.perf_counter() - start}
+            if event.get('status') == 'error':
+                return {'ok': False, 'error': event.get('message'), 'first_event_s': first_event, 'complete_s': time.perf_counter() - start}
+    return {'ok': False, 'error': 'Stream ended without a result', 'first_event_s': first_event, 'complete_s': time.perf_counter() - start}
+
+
+async def form_login(session: aiohttp.ClientSession, target: str, username: str, password: str) -> dict:
+    start = time.perf_counter()
+    async with session.post(f'{target}/', data={'UserName': username, 'Password': password}) as response:
+        first_event = time.perf_counter() - start
+        body = await response.json(content_type=None)
+        ok = response.status == 200 and body.get('success', False)
+        return {'ok': ok, 'error': None if ok else body.get('message', f'HTTP {response.status}'), 'first_event_s': first_event, 'complete_s': time.perf_counter() - start}
+
+
+async def run(args) -> dict:
+    login = sse_login if args.variant == 'sse' else form_login
+    semaphore = asyncio.Semaphore(args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async def one(i: int, session: aiohttp.ClientSession):
+        async with semaphore:
+            try:
+                return await login(session, args.target, f'{args.username}-{i}', args.password)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                return {'ok': False, 'error': type(e).__name__, 'first_event_s': None, 'complete_s': None}
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[one(i, session) for i in range(args.requests)])
+        wall = time.perf_counter() - start
+
+    completed = [r for r in results if r['ok']]
+    errors = {}
+    for r in results:
+        if not r['ok']:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+
+    return {
+        'label': args.label or args.variant,
+        'target': args.target,
+        'variant': args.variant,
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'completed': len(completed),
+        'error_rate': round(1 - len(completed) / len(results), 4),
+        'errors': errors,
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(len(completed) / wall, 3),
+        'time_to_first_event_s': summarize([r['first_event_s'] for r in results if r['first_event_s'] is not None]),
+        'time_to_complete_s': summarize([r['complete_s'] for r in completed]),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent /login load generator')
+    parser.add_argument('target', help='Base url of the server under test, e.g. http://127.0.0.1:8000')
+    parser.add_argument('--variant', choices=VARIANTS, default='sse')
+    parser.add_argument('--concurrency', type=int, default=20, help='Logins in flight at once')
+    parser.add_argument('--requests', type=int, default=None, help='Total logins, defaults to --concurrency')
+    parser.add_argument('--username', default='load-test', help='Username prefix, each login gets a unique suffix')
+    parser.add_argument('--password', default='secret')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds before a login counts as failed')
+    parser.add_argument('--label', default=None, help='Name of the server variant in the report')
+    parser.add_argument('--output', default=None, help='Also write the report to this file')
+    args = parser.parse_args()
+    args.requests = args.requests or args.concurrency
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -2,8 +2,10 @@ from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
+from parsing import make_soup, parse_time, get_course_details
+from portal import aiub_portal_url
+import curriculum_graph
+import deadlines
 import os
 import re
 import concurrent.futures
@@ -22,8 +24,6 @@ client_url = os.environ.get('CLIENT_URL')
 
 print(f'Client url: {client_url}')
 
-default_parser = 'html.parser'
-
 # Allow CORS to client_url
 app.add_middleware(
     CORSMiddleware,
@@ -63,41 +63,6 @@ emojis = {
     '🥹'
 }
 
-def parse_time(time_string: str):
-    try:
-        match = re.findall(r'\d{1,2}:\d{1,2}(?:\s?[ap]m|\s?[AP]M)?', time_string)
-        day_map = {'Sun': 'Sunday', 'Mon': 'Monday', 'Tue': 'Tuesday', 'Wed': 'Wednesday', 'Thu': 'Thursday', 'Fri': 'Friday', 'Sat': 'Saturday'}
-        class_type = re.search(r'\((.*?)\)', time_string).group(1)
-        day = day_map[re.search(r'(Sun|Mon|Tue|Wed|Thu|Fri|Sat)', time_string).group()]
-        room = re.search(r'Room: (.*)', time_string).group(1)
-        start_time, end_time = match[0], match[1]
-        start_time_obj = ''
-        end_time_obj = ''
-        #if time contains am/pm or AM/PM
-        AM_TIME_FORMAT = '%I:%M'
-        PM_TIME_FORMAT = AM_TIME_FORMAT + ' %p'
-        if "am" in start_time.lower() or "pm" in start_time.lower():
-            start_time_obj = datetime.strptime(start_time, PM_TIME_FORMAT)
-        else:
-            start_time_obj = datetime.strptime(start_time, AM_TIME_FORMAT)
-        if "am" in end_time.lower() or "pm" in end_time.lower():
-            end_time_obj = datetime.strptime(end_time, PM_TIME_FORMAT)
-        else:
-            end_time_obj = datetime.strptime(end_time, AM_TIME_FORMAT)
-
-        start_time_formatted = start_time_obj.strftime(PM_TIME_FORMAT)
-        end_time_formatted = end_time_obj.strftime(PM_TIME_FORMAT)
-        final_time = f"{start_time_formatted} - {end_time_formatted}"
-        data = {
-            "type": class_type,
-            "time": final_time,
-            "day": day,
-            "room": room
-        }
-        return data
-    except IndexError:
-        print("Time not found in the string.")
-
 
 # allow client url to access the api
 @app.middleware("http")
@@ -120,15 +85,16 @@ async def forward_request(request: Request):
         form = await request.form()
         username = form['UserName']
         password = form['Password']
-        url = 'https://portal.aiub.edu'
+        url = aiub_portal_url
         
+        deadline = deadlines.Deadline(deadlines.LOGIN_DEADLINE)
         session = requests.Session()
-        response = session.post(url, data={'UserName': username, 'Password': password})
+        response = portal_call(deadline, 'login', session.post, url, data={'UserName': username, 'Password': password})
 
         if response.status_code != 200:
             return JSONResponse({'success': False, 'message': 'Error in request'}, status_code=403)
 
-        if 'https://portal.aiub.edu/Student' not in response.url:
+        if f'{aiub_portal_url}/Student' not in response.url:
             print('Login failed')
             return JSONResponse({'success': False, 'message': 'Invalid username or password'}, status_code=401)
 
@@ -138,10 +104,11 @@ async def forward_request(request: Request):
 
         print('Login successful')
 
-        response = session.get('https://portal.aiub.edu/Student')
+        response = portal_call(deadline, 'login', session.get, f'{aiub_portal_url}/Student')
+        check_stage(deadline, 'login')
         cookies = session.cookies.get_dict()
 
-        soup = BeautifulSoup(response.text, default_parser)
+        soup = make_soup(response.text)
         targets = soup.select("#SemesterDropDown > option")
         user = soup.select_one('.navbar-link').text
 
@@ -156,28 +123,32 @@ async def forward_request(request: Request):
         course_map = {} # contains all course info
         completed_courses = {} # contains all completed courses info
         current_semester_courses = {} # contains all current semester courses info
-        unlocked_courses = {} # contains all unlocked courses info
         pre_registered_courses = {} # contains all pre-registered courses info
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        executor = concurrent.futures.ThreadPoolExecutor()
+        try:
             # Execute getCurricumnData concurrently
-            course_map_future = executor.submit(get_curricumn_data, cookies, session)
+            course_map_future = executor.submit(get_curricumn_data, cookies, session, deadline)
 
-            completed_courses_map_future = executor.submit(get_completed_courses, cookies, session, current_semester)
+            completed_courses_map_future = executor.submit(get_completed_courses, cookies, session, current_semester, deadline)
 
             # Execute process_semester concurrently for each target
-            futures = [executor.submit(process_semester, target, session, cookies) for target in targets]
+            futures = [executor.submit(process_semester, target, session, cookies, deadline) for target in targets]
                         # Wait for getCurricumnData to complete and retrieve the result
-            course_map = course_map_future.result()
+            course_map = stage_result(course_map_future, deadline, 'curriculum')
 
             # Wait for getGradeReport to complete and retrieve the result
-            completed_courses = completed_courses_map_future.result()[0]
-            current_semester_courses = completed_courses_map_future.result()[1]
-            pre_registered_courses = completed_courses_map_future.result()[2]
+            completed_courses, current_semester_courses, pre_registered_courses = stage_result(completed_courses_map_future, deadline, 'grades')
 
             # Wait for process_semester tasks to complete and update semesters
-            for future in concurrent.futures.as_completed(futures):
-                semester_class_routine.update(future.result())
+            try:
+                for future in concurrent.futures.as_completed(futures, timeout=max(0, deadline.stage_remaining('semesters'))):
+                    semester_class_routine.update(future.result())
+            except concurrent.futures.TimeoutError:
+                raise deadlines.StageTimeout('semesters')
+        finally:
+            # Requests still running can't be stopped, but nobody waits for them or starts new ones
+            executor.shutdown(wait=False, cancel_futures=True)
 
             
         # Sort the semesters by year
@@ -185,14 +156,9 @@ async def forward_request(request: Request):
         
         print('Processing data...')
 
-        # Iterate over the gradesMap. A student can take a course after completing the prerequisites. And also if he/she has taken the course before, he must have D grade
-        for course_code, course in completed_courses.items():
-            # If student has taken the course before and has D grade, then he/she can take the course again
-            if course['grade'] == 'D':
-                unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course_map[course_code]['credit'], 'prerequisites': course_map[course_code]['prerequisites'], 'retake': True}
-
-        # Add unlocked courses to the unlockedCourses dictionary
-        unlocked_courses = add_unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses)
+        # D grades can be retaken, other courses need their prerequisites completed or in progress
+        curriculum_graph.add_credits(completed_courses, course_map)
+        unlocked_courses = curriculum_graph.unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses)
 
         # Need to get more data like completed courses, credits_completed, credits_remaining, course_completed_count
 
@@ -202,50 +168,49 @@ async def forward_request(request: Request):
 
         return JSONResponse({'result': result, 'success': True}, status_code=200)
     
+    except deadlines.StageTimeout as e:
+        print(f'Login timed out in stage {e.stage}')
+        return JSONResponse({'success': False, 'message': f'{e}. The portal is slow, try again later', 'stage': e.stage}, status_code=504)
+    except requests.exceptions.Timeout:
+        print('Login timed out')
+        return JSONResponse({'success': False, 'message': 'AIUB portal took too long to respond. Try again later'}, status_code=504)
     except Exception as e:
         print(e)
         return JSONResponse({'success': False, 'message': 'Something went wrong'}, status_code=500)
     
 
-def add_unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses):
-    for course_code, course in course_map.items():
-        if should_skip_course(course_code, course, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses):
-            continue
+def portal_call(deadline: deadlines.Deadline, stage: str, method, *args, **kwargs):
+    # One portal request of stage, with (connect, read) timeouts never past what the stage has left.
+    # requests can't cap a whole response, the waits for each stage's results do that
+    remaining = check_stage(deadline, stage)
+    try:
+        return method(*args, timeout=(min(deadlines.PORTAL_CONNECT_TIMEOUT, remaining), min(deadlines.PORTAL_READ_TIMEOUT, remaining)), **kwargs)
+    except requests.exceptions.Timeout:
+        # Our own budget running out is reported with the stage
+        check_stage(deadline, stage)
+        raise
+
 
-        prerequisites = course['prerequisites']
-        if len(prerequisites) == 0 or are_prerequisites_met(prerequisites, completed_courses, current_semester_courses):
-            unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course['credit'], 'prerequisites': course['prerequisites'], 'retake': False}
-
-    return unlocked_courses
-
-def should_skip_course(course_code, course, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses):
-    if course_code in completed_courses:
-        completed_courses[course_code]['credit'] = course['credit']
-        return True
-    if '#' in course_code or '*' in course_code:
-        return True
-    if course['course_name'] == 'INTERNSHIP':
-        return True
-    if course_code in unlocked_courses:
-        return True
-    if (course_code in current_semester_courses and course["course_name"] == current_semester_courses[course_code]["course_name"]) and current_semester_courses[course_code]['grade'] not in ['W', 'I']:
-        return True
-    if course_code in pre_registered_courses:
-        unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course['credit'], 'prerequisites': course['prerequisites'], 'retake': False}
-        return True
-    return False
-
-def are_prerequisites_met(prerequisites, completed_courses, current_semester_courses):
-    for prerequisite in prerequisites:
-        if prerequisite not in completed_courses and prerequisite not in current_semester_courses:
-            return False
-    return True
-
-
-def get_curricumn_data(cookies, session):
-    get_curricumn_link = 'https://portal.aiub.edu/Student/Curriculum'
-    response = session.get(get_curricumn_link, cookies=cookies)
-    soup = BeautifulSoup(response.text, default_parser)
+def check_stage(deadline: deadlines.Deadline, stage: str) -> float:
+    # Seconds stage has left, StageTimeout if none
+    remaining = deadline.stage_remaining(stage)
+    if remaining <= 0:
+        raise deadlines.StageTimeout(stage)
+    return remaining
+
+
+def stage_result(future, deadline: deadlines.Deadline, stage: str):
+    # Result of the work of stage, StageTimeout once the stage is out of time
+    try:
+        return future.result(timeout=max(0, deadline.stage_remaining(stage)))
+    except concurrent.futures.TimeoutError:
+        raise deadlines.StageTimeout(stage)
+
+
+def get_curricumn_data(cookies, session, deadline: deadlines.Deadline):
+    get_curricumn_link = f'{aiub_portal_url}/Student/Curriculum'
+    response = portal_call(deadline, 'curriculum', session.get, get_curricumn_link, cookies=cookies)
+    soup = make_soup(response.text)
     target_elements = soup.select('[curriculumid]')
     curricumn_id = []
     for target in target_elements:
@@ -256,7 +221,7 @@ def get_curricumn_data(cookies, session):
 
     with concurrent.futures.ThreadPoolExecutor() as executor:
         # Execute process_curriculum concurrently
-        futures = [executor.submit(process_curriculum, ID, session, cookies) for ID in curricumn_id]
+        futures = [executor.submit(process_curriculum, ID, session, cookies, deadline) for ID in curricumn_id]
 
         # Wait for process_curriculum tasks to complete and update courseMap
         for future in concurrent.futures.as_completed(futures):
@@ -264,11 +229,11 @@ def get_curricumn_data(cookies, session):
 
     return course_map
 
-def process_curriculum(id: str, session, cookies):
+def process_curriculum(id: str, session, cookies, deadline: deadlines.Deadline):
     # Request the getCurricumnLink?IDd=curriculumId
     course_map = {}
-    response = session.get(f'https://portal.aiub.edu/Common/Curriculum?ID={id}', cookies=cookies)
-    soup = BeautifulSoup(response.text, default_parser)
+    response = portal_call(deadline, 'curriculum', session.get, f'{aiub_portal_url}/Common/Curriculum?ID={id}', cookies=cookies)
+    soup = make_soup(response.text)
     table = soup.select('.table-bordered tr:not(:first-child)')
 
     for course in table:
@@ -281,10 +246,10 @@ def process_curriculum(id: str, session, cookies):
 
     return course_map
 
-def get_completed_courses(cookies, session, current_semester: str): 
-    url = 'https://portal.aiub.edu/Student/GradeReport/ByCurriculum'
-    response = session.get(url, cookies=cookies)
-    soup = BeautifulSoup(response.text, default_parser)
+def get_completed_courses(cookies, session, current_semester: str, deadline: deadlines.Deadline): 
+    url = f'{aiub_portal_url}/Student/GradeReport/ByCurriculum'
+    response = portal_call(deadline, 'grades', session.get, url, cookies=cookies)
+    soup = make_soup(response.text)
     rows = soup.select('table:not(:first-child) tr:not(:first-child):has(td:nth-child(3):not(:empty))')
 
     completed_courses = {}
@@ -321,14 +286,14 @@ def get_completed_courses(cookies, session, current_semester: str):
     return [completed_courses, current_semester_courses, pre_registered_courses]
 
 
-def process_semester(target, session, cookies):
+def process_semester(target, session, cookies, deadline: deadlines.Deadline):
     semesters = {}
     match = re.search(r'q=(.*)', target.attrs['value'])
     if match is not None and len(match.groups()) > 0:
         try:
-            rq_url = 'https://portal.aiub.edu/Student/Registration?q=' + match.group(1)
-            response = session.get(rq_url, cookies=cookies)
-            soup = BeautifulSoup(response.text, default_parser)
+            rq_url = f'{aiub_portal_url}/Student/Registration?q=' + match.group(1)
+            response = portal_call(deadline, 'semesters', session.get, rq_url, cookies=cookies)
+            soup = make_soup(response.text)
             table = soup.select("table")
             raw_course_elements = table[1].select("td:first-child")
             courses_obj = {}
@@ -341,6 +306,8 @@ def process_semester(target, session, cookies):
                     credit = sorted([int(c.strip()) for c in credit.split('-')], reverse=True)[0]
                     courses_obj = process_course_times(course_times, parsed_course, credit, courses_obj)
             semesters[target.text] = courses_obj
+        except (requests.exceptions.Timeout, deadlines.StageTimeout):
+            raise
         except Exception as e:
             print('Error in process_semester: ', e)
     return semesters
@@ -354,19 +321,3 @@ def process_course_times(course_times, parsed_course, credit, courses_obj):
             courses_obj[parsed_time['day']] = {}
         courses_obj[parsed_time['day']][parsed_time['time']] = {'course_name': parsed_course['course_name'], 'class_id': parsed_course['class_id'], 'credit': credit, 'section': parsed_course['section'], 'type': parsed_time['type'], 'room': parsed_time['room']}
     return courses_obj
-
-
-def get_course_details(course):
-    match = re.match(r"^(\d+)-(.+?)\s+\[([A-Z0-9]+)\](?:\s+\[([A-Z0-9]+)\])?$", course)
-    try:
-        if match:
-            class_id = match.group(1)
-            course_name = match.group(2).title()
-            section = match.group(4) if match.group(4) else match.group(3)
-            return {"class_id": class_id, "course_name": course_name, "section": section}
-        else:
-            print("Course not found in the string:", course)
-            return {"class_id": "", "course_name": "", "section": ""}
-    except IndexError:
-        print("Course not found in the string:", course)
-        return {"class_id": "", "course_name": "", "section": ""}
@@ -1,16 +1,26 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
+from bs4 import SoupStrainer
+from parsing import make_soup, select_partial, class_strainer, TABLE_PAGE_PARSERS, grade_report_rows, parse_time, get_course_details
 import os
 import re
 import json
+import asyncio
+from contextlib import aclosing
 from dotenv import load_dotenv
 
 from notice import r, check_redis_connection, process_new_notices, update_clients, redis_error_message, send_web_push, CLIENTS_KEY, NOTICE_CHANNEL
+import portal
+import cache
+import metrics
+import deadlines
+import jobs
+import sync
+import events
+import curriculum_graph
+from governor import get_governor
 
 load_dotenv()
 
@@ -20,9 +30,14 @@ PORT = int(os.environ.get('PORT', 5000))
 client_url = os.environ.get('CLIENT_URL')
 VAPID_PUBLIC_KEY = os.environ.get('VAPID_PUBLIC_KEY')
 
-aiub_portal_url = 'https://portal.aiub.edu'
-
-default_parser = 'html.parser'
+# Max number of registration pages fetched at once per login
+SEMESTER_CONCURRENCY = int(os.environ.get('SEMESTER_CONCURRENCY', 4))
+# Max number of curriculum pages fetched at once per login
+CURRICULUM_CONCURRENCY = int(os.environ.get('CURRICULUM_CONCURRENCY', 4))
+# Curricula are the same for every student, so they are shared across users for this long (seconds)
+CURRICULUM_CACHE_TTL = int(os.environ.get('CURRICULUM_CACHE_TTL', 12 * 60 * 60))
+# Credits per semester /plan assumes unless the client asks for another cap
+PLAN_CREDIT_CAP = int(os.environ.get('PLAN_CREDIT_CAP', 15))
 
 print(f'Client URL: {client_url}')
 
@@ -139,9 +154,70 @@ async def forward_request(request: Request):
     # query parameters
     username = request.query_params.get('username')
     password = request.query_params.get('password')
+    # Opt-in per-stage timings in the complete event
+    timings = request.query_params.get('timings') in ['1', 'true']
+    # Opt-in snapshot event with the last known result before the fresh scrape finishes
+    snapshot = request.query_params.get('snapshot') in ['1', 'true']
+    # Opt-in incremental sync, JSON object of semester name -> hash of the routine the client holds
+    known = sync.parse_hashes(request.query_params.get('known'))
+    # Opt-in delta, JSON object of result section -> version the client holds
+    versions = sync.parse_hashes(request.query_params.get('versions'))
+    # Opt-in partial events carrying each section of the result as soon as it is ready
+    progressive = request.query_params.get('progressive') in ['1', 'true']
+    # Sent by EventSource when it reconnects, the login continues after that event
+    last_event_id = request.headers.get('last-event-id')
+
+    stream = login_stream(username, password, timings, snapshot, known, versions, progressive, last_event_id)
+    headers = {'Vary': 'Accept-Encoding'}
+    if events.accepts_gzip(request.headers.get('accept-encoding')):
+        stream = events.gzip_stream(stream)
+        headers['Content-Encoding'] = 'gzip'
 
     # Return the streaming response
-    return StreamingResponse(event_stream(username, password), media_type="text/event-stream")
+    return StreamingResponse(stream, media_type="text/event-stream", headers=headers)
+
+
+class PlanRequest(BaseModel):
+    curriculumId: str  # curriculumId of the login result
+    completed: list[str] = []
+    current: list[str] = []
+    creditCap: int = PLAN_CREDIT_CAP
+    unlock: str | None = None  # Also answer what passing this course unlocks
+
+
+@app.post('/plan')
+async def plan(request: PlanRequest):
+    if request.creditCap <= 0:
+        return {"status": "error", "message": "Credit cap must be positive"}
+    graph = await curriculum_graph_for(request.curriculumId)
+    if graph is None:
+        return {"status": "error", "message": "Curriculum not found, log in again"}
+    if request.unlock is not None and request.unlock not in graph.source:
+        return {"status": "error", "message": "Course not found in curriculum"}
+    result = curriculum_graph.plan_degree(graph, request.completed, request.current, request.creditCap)
+    if request.unlock is not None:
+        result['unlocks'] = curriculum_graph.unlocks_after(graph, request.completed, request.current, request.unlock)
+    return {"status": "success", **result}
+
+
+async def curriculum_graph_for(curriculum_id: str):
+    # Compiled graph of a curriculum scraped by a login, from this process or rebuilt from the
+    # shared curriculum cache. Clients only name curricula, they can't upload their own
+    graph = curriculum_graph.cached_graph(curriculum_id)
+    if graph is not None:
+        return graph
+    course_map = {}
+    for _id in curriculum_id.split('+'):
+        curriculum = await cache.get_cached(f'curriculum:{_id}')
+        if curriculum is None:
+            return None
+        course_map.update(curriculum)
+    return curriculum_graph.compile_graph(course_map, curriculum_id)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    return Response(content=metrics.latest(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.get("*")
@@ -160,124 +236,274 @@ def get_host(url: str | None) -> str:
         return ''
 
 
-async def event_stream(username: str, password: str):
+async def login_stream(username: str, password: str, timings: bool = False, snapshot: bool = False, known: dict | None = None, versions: dict | None = None, progressive: bool = False, last_event_id: str | None = None):
+    # SSE lines for one /login request. Identical concurrent logins share one scrape,
+    # a request with last_event_id continues the login that event came from
+    previous = None
+    if not username or not password:
+        # event_stream reports the missing credentials
+        source = ((None, payload, False) async for payload in event_stream(username, password))
+    else:
+        key = cache.credentials_key(username, password)
+        cipher = cache.credentials_cipher(username, password)
+        if snapshot:
+            previous = await cache.load_snapshot(key, cipher)
+            if previous is not None and last_event_id is None:
+                yield events.format_event({"status": "snapshot", "result": previous['result'], "updatedAt": previous['updatedAt']})
+        # The shared scrape always collects timings and builds the full result, each request
+        # decides whether to send the timings and which parts of the result it still needs
+        source = jobs.subscribe(key, cipher, lambda: event_stream(username, password, True, known), last_event_id)
+
+    # Set once events were dropped before we got them, then the partial events may be incomplete
+    missed = False
+    async for event_id, payload, dropped in source:
+        missed = missed or dropped
+        if payload['status'] == 'partial':
+            if not progressive:
+                continue
+            payload = partial_delta(payload, known, versions)
+            if payload is None:
+                continue
+        if not timings and 'timings' in payload:
+            payload = {k: v for k, v in payload.items() if k != 'timings'}
+        if previous is not None and payload['status'] == 'complete' and cache.content_hash(payload['result']) == previous['hash']:
+            # The client already shows this result
+            payload = {k: v for k, v in payload.items() if k != 'result'}
+            payload['status'] = 'unchanged'
+        if payload['status'] == 'complete' and (known is not None or versions is not None):
+            payload = dict(payload, result=sync.delta(payload['result'], known, versions))
+        if payload['status'] == 'complete' and progressive and not payload.get('stale') and not missed:
+            # Every section already went out in a partial event, only the sync fields are left
+            payload = dict(payload, result={k: v for k, v in payload['result'].items() if k not in PARTIAL_KEYS})
+        yield events.format_event(payload, event_id)
+
+
+# Keys of the result sent in partial events, each partial result is merged into the previous ones
+PARTIAL_KEYS = ['user', 'currentSemester', 'curriculumncourses', 'curriculumId', 'completedCourses', 'preregisteredCourses', 'semesterClassRoutine', 'unlockedCourses']
+
+
+def partial(section: str, result: dict) -> dict:
+    return {"status": "partial", "section": section, "result": result}
+
+
+def partial_delta(payload: dict, known: dict | None, versions: dict | None):
+    # Partial event without what this client holds unchanged, None if nothing is left: the sections
+    # listed in versions, and the semesters listed in known. A semester event only has part of the routine,
+    # so the routine's version can't drop it. The shared scrape sends every semester, also the ones it
+    # reused for the known of the request that started it
+    result = dict(payload['result'])
+    if versions:
+        for section in sync.SECTIONS:
+            if section in result and section != 'semesterClassRoutine' and versions.get(section) == cache.content_hash(result[section]):
+                del result[section]
+    if payload['section'] == 'semester' and known:
+        routine = {name: courses for name, courses in result['semesterClassRoutine'].items() if known.get(name) != cache.content_hash(courses)}
+        if routine:
+            result['semesterClassRoutine'] = routine
+        else:
+            del result['semesterClassRoutine']
+    if not result:
+        return None
+    return dict(payload, result=result)
+
+
+async def event_stream(username: str, password: str, timings: bool = False, known: dict | None = None):
+    # The login pipeline, yields the payload of every event
+    timer = metrics.start_timer()
+    outcome = 'error'
+    admitted = False
     try:
         
         # Notify the client that processing has started
         print('Processing request...')
-        yield f'data: {json.dumps({"status": "running", "message": "Processing request..."})}\n\n'
+        yield {"status": "running", "message": "Processing request..."}
 
         if username is None or password is None:
-            yield f'data: {json.dumps({"status": "error", "message": "Username and password are required"})}\n\n'
+            yield {"status": "error", "message": "Username and password are required"}
             return
         
         # if empty username or password
         if username == '' or password == '':
-            yield f'data: {json.dumps({"status": "error", "message": "Username and password are required"})}\n\n'
+            yield {"status": "error", "message": "Username and password are required"}
             return
         
-        session = requests.Session()
-        response = session.post(aiub_portal_url, data={'UserName': username, 'Password': password})
-
-        if response.status_code != 200:
-            if response.status_code >= 500:
-                print('Server error. Try again later')
-                yield f'data: {json.dumps({"status": "error", "message": "AIUB Server error. Try again later"})}\n\n'
-                return
-            print("Error in request")
-            yield f'data: {json.dumps({"status": "error", "message": "Error in request"})}\n\n'
-            return
-
-        if 'https://portal.aiub.edu/Student' not in response.url:
-            # check if captcha is required
-            cap_elem = BeautifulSoup(response.text, default_parser).select_one('#captcha')
-            if cap_elem is not None and cap_elem.attrs.get('style') != 'display: none':
-                print('Captcha required')
-                yield f'data: {json.dumps({"status": "error", "message": "Captcha required. Solve it from portal."})}\n\n'
-                return
-            print('Invalid username or password')
-            print(f'Response URL: "{response.url}"')
-            yield f'data: {json.dumps({"status": "error", "message": "Invalid username or password"})}\n\n'
-            return
-        
-        # Login successful
-        print('Login successful')
-        yield f'data: {json.dumps({"status": "running", "message": "Logged in to portal"})}\n\n'
-
-        if 'Student/Tpe/Start' in response.url:
-            yield f'data: {json.dumps({"status": "error", "message": "TPE Evaluation Pending"})}\n\n'
-            return
-
-        response = session.get('https://portal.aiub.edu/Student')
-        
-        cookies = session.cookies.get_dict()
-
-        soup = BeautifulSoup(response.text, default_parser)
-        targets = soup.select("#SemesterDropDown > option")
-        user = soup.select_one('.navbar-link').text
-
-        if ',' in user:
-            user = user.split(',')
-            user = user[1].strip() + ' ' + user[0].strip()
-
-        user = user.title()
-
-        current_semester = soup.select_one('#SemesterDropDown > option[selected="selected"]').text
-        semester_class_routine = {}
-
-        # use the following code to run the code synchronously
-        yield f'data: {json.dumps({"status": "running", "message": "Getting curriculum data..."})}\n\n'
-        course_map = get_curricumn_data(cookies, session)
-        
-        yield f'data: {json.dumps({"status": "running", "message": "Completed getting curriculum data"})}\n\n'
-
-        
-        yield f'data: {json.dumps({"status": "running", "message": "Getting completed courses..."})}\n\n'
-        completed_courses, current_semester_courses, pre_registered_courses = get_completed_courses(cookies, session, current_semester)
-        
-        yield f'data: {json.dumps({"status": "running", "message": "Completed getting completed courses"})}\n\n'
-
-        
-        yield f'data: {json.dumps({"status": "running", "message": "Fetching semester data..."})}\n\n'
-        for target in targets:
-            yield f'data: {json.dumps({"status": "running", "message": "Analyzing: " + target.text})}\n\n'
-            semester_class_routine.update(process_semester(target, session, cookies))
-        
-        yield f'data" {json.dumps({"status": "running", "message": "Completed processing semesters"})}\n\n'
-
-        # Sort the semesters
-        semester_class_routine = dict(sorted(semester_class_routine.items(), key=lambda x: x[0]))
-
-        yield f'data: {json.dumps({"status": "running", "message": "Packing all data..."})}\n\n'
-        
-        result = pack_data(completed_courses, current_semester_courses, pre_registered_courses, semester_class_routine, course_map, user, current_semester)
+        key = cache.credentials_key(username, password)
+        cipher = cache.credentials_cipher(username, password)
+
+        # Don't queue for a portal we know is down
+        if portal.breaker.is_open():
+            raise portal.PortalUnavailable()
+
+        # Wait for our turn when the portal is busy
+        with timer.stage('queue'):
+            async for position in get_governor().admit():
+                yield {"status": "queued", "position": position, "message": f"Portal is busy, you are number {position} in the queue"}
+        admitted = True
+        deadline = deadlines.start_deadline()
+
+        async with portal.new_session() as session:
+            home = None
+            # A recent login of the same user lets us skip the login POST and redirects
+            if await portal.restore_cookies(session, key, cipher):
+                with timer.stage('login'), deadline.stage('login'):
+                    home = await portal.resume(session)
+                if home is None:
+                    print('Saved portal session was rejected, logging in again')
+                    await portal.forget_cookies(session, key)
+                else:
+                    print('Reusing portal session')
+                    yield {"status": "running", "message": "Logged in to portal"}
+
+            if home is None:
+                with timer.stage('login'), deadline.stage('login'):
+                    status, response_url, response_text = await portal.login(session, username, password)
+
+                if status != 200:
+                    if status >= 500:
+                        print('Server error. Try again later')
+                        raise portal.PortalUnavailable('AIUB Server error. Try again later')
+                    print("Error in request")
+                    yield {"status": "error", "message": "Error in request"}
+                    return
+
+                if f'{portal.aiub_portal_url}/Student' not in response_url:
+                    # check if captcha is required
+                    cap_elem = make_soup(response_text).select_one('#captcha')
+                    if cap_elem is not None and cap_elem.attrs.get('style') != 'display: none':
+                        print('Captcha required')
+                        yield {"status": "error", "message": "Captcha required. Solve it from portal."}
+                        return
+                    print('Invalid username or password')
+                    print(f'Response URL: "{response_url}"')
+                    yield {"status": "error", "message": "Invalid username or password"}
+                    return
+                
+                # Login successful
+                print('Login successful')
+                yield {"status": "running", "message": "Logged in to portal"}
+
+                if 'Student/Tpe/Start' in response_url:
+                    yield {"status": "error", "message": "TPE Evaluation Pending"}
+                    return
+
+                with timer.stage('login'), deadline.stage('login'):
+                    home = await portal.get_page(session, '/Student')
+                await portal.save_cookies(session, key, cipher)
+
+            soup = make_soup(home)
+            targets = soup.select("#SemesterDropDown > option")
+            user = soup.select_one('.navbar-link').text
+
+            if ',' in user:
+                user = user.split(',')
+                user = user[1].strip() + ' ' + user[0].strip()
+
+            user = user.title()
+
+            current_semester = soup.select_one('#SemesterDropDown > option[selected="selected"]').text
+            semester_class_routine = {}
+            yield partial('user', {'user': user, 'currentSemester': current_semester})
+
+            if known:
+                # Past semesters the client holds unchanged are taken from our last result instead of the portal
+                previous = await cache.load_snapshot(key, cipher)
+                if previous is not None:
+                    reused = sync.reusable_semesters([target.text for target in targets], current_semester, known, previous['result']['semesterClassRoutine'])
+                    print(f'Reusing {len(reused)} of {len(targets)} semesters')
+                    semester_class_routine.update(reused)
+                    targets = [target for target in targets if target.text not in reused]
+                    if reused:
+                        # Subscribers sharing this login may not hold them, see login_stream
+                        yield partial('semester', {'semesterClassRoutine': reused})
+
+            yield {"status": "running", "message": "Getting curriculum data..."}
+            with timer.stage('curriculum'), deadline.stage('curriculum'):
+                course_map, curriculum_id = await deadline.run(get_curricumn_data(session))
+            
+            yield {"status": "running", "message": "Completed getting curriculum data"}
+            yield partial('curriculum', {'curriculumncourses': course_map, 'curriculumId': curriculum_id})
+
+            
+            yield {"status": "running", "message": "Getting completed courses..."}
+            with timer.stage('grades'), deadline.stage('grades'):
+                completed_courses, current_semester_courses, pre_registered_courses = await deadline.run(get_completed_courses(session, current_semester))
+            
+            yield {"status": "running", "message": "Completed getting completed courses"}
+            # Credits are filled in from the curriculum while packing, do it now so the partial grades are final
+            curriculum_graph.add_credits(completed_courses, course_map)
+            yield partial('grades', {'completedCourses': completed_courses, 'preregisteredCourses': pre_registered_courses})
+
+            
+            yield {"status": "running", "message": "Fetching semester data..."}
+            with timer.stage('semesters'), deadline.stage('semesters'):
+                # Closed right away if we are stopped while yielding, so no page outlives the session
+                async with aclosing(process_semesters(targets, session)) as semesters:
+                    async for semester, routine in semesters:
+                        yield {"status": "running", "message": "Analyzing: " + semester}
+                        semester_class_routine.update(routine)
+                        if routine:
+                            yield partial('semester', {'semesterClassRoutine': routine})
+            
+            yield {"status": "running", "message": "Completed processing semesters"}
+
+        yield {"status": "running", "message": "Packing all data..."}
+
+        with timer.stage('pack'):
+            # Sort the semesters
+            semester_class_routine = dict(sorted(semester_class_routine.items(), key=lambda x: x[0]))
+            result = pack_data(completed_courses, current_semester_courses, pre_registered_courses, semester_class_routine, course_map, user, current_semester, curriculum_id)
+
+        yield partial('unlocked', {'unlockedCourses': result['unlockedCourses']})
 
         print('Data processing complete')
+        await cache.save_snapshot(key, cipher, result)
+        outcome = 'complete'
+        complete = {"status": "complete", "result": result}
+        if timings:
+            complete["timings"] = timer.summary()
         # send as data: {status: 'complete', result: result}
-        yield f'data: {json.dumps({"status": "complete", "result": result})}\n\n'
+        yield complete
+        return
+
+    except deadlines.StageTimeout as e:
+        print(f'Login timed out in stage {e.stage}')
+        outcome = 'timeout'
+        yield {"status": "error", "message": f'{e}. The portal is slow, try again later', "stage": e.stage}
+        return
+
+    except portal.PortalUnavailable as e:
+        print('Portal unavailable')
+        # The last result we have is better than nothing, marked as stale
+        previous = await cache.load_snapshot(key, cipher)
+        if previous is not None:
+            outcome = 'stale'
+            yield {"status": "complete", "result": previous['result'], "stale": True, "updatedAt": previous['updatedAt'], "message": "AIUB portal is not responding, showing your last saved data"}
+            return
+        yield {"status": "error", "message": str(e) or "AIUB portal is not responding. Try again later"}
         return
 
     except Exception as e:
         print('Error in event_stream:', e)
-        yield f"data: {json.dumps({'status': 'error', 'message': str(e)})}\n\n"
+        yield {'status': 'error', 'message': str(e)}
         return
 
+    except (asyncio.CancelledError, GeneratorExit):
+        # Every client left and jobs.py stopped the login, in flight requests and pages are cancelled with us
+        print(f'Login abandoned in stage {timer.last}')
+        outcome = 'abandoned'
+        metrics.ABANDONED_LOGINS.labels(timer.last or 'queue').inc()
+        raise
 
-def pack_data(completed_courses, current_semester_courses, pre_registered_courses, semester_class_routine, course_map, user, current_semester):
+    finally:
+        if admitted:
+            get_governor().leave()
+        timer.finish(outcome)
 
-    unlocked_courses = {}
 
-    # Iterate over completed courses
-    for course_code, course in completed_courses.items():
-        if course['grade'] == 'D':
-            unlocked_courses[course_code] = {
-                'course_name': course['course_name'],
-                'credit': course_map[course_code]['credit'],
-                'prerequisites': course_map[course_code]['prerequisites'],
-                'retake': True
-            }
+def pack_data(completed_courses, current_semester_courses, pre_registered_courses, semester_class_routine, course_map, user, current_semester, curriculum_id):
 
-    unlocked_courses = add_unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses)
+    curriculum_graph.add_credits(completed_courses, course_map)
+    unlocked_courses = curriculum_graph.unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses, curriculum_id)
 
     result = {
         'semesterClassRoutine': semester_class_routine,
@@ -286,60 +512,15 @@ def pack_data(completed_courses, current_semester_courses, pre_registered_course
         'preregisteredCourses': pre_registered_courses,
         'currentSemester': current_semester,
         'user': user,
-        'curriculumncourses': course_map
+        'curriculumncourses': course_map,
+        'curriculumId': curriculum_id,  # Names the curriculum for /plan
     }
     
     return result
 
 
-def add_unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses):
-
-    for course_code, course in course_map.items():
-        if should_skip_course(course_code, course, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses):
-            continue
-
-        prerequisites = course['prerequisites']
-        if len(prerequisites) == 0 or are_prerequisites_met(prerequisites, completed_courses, current_semester_courses):
-            unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course['credit'], 'prerequisites': course['prerequisites'], 'retake': False}
-
-    return unlocked_courses
-
-def skip_primary(all_courses, course_code):
-    if course_code == '0':
-        return True
-    if '#' in course_code or '*' in course_code:
-        return True
-    if all_courses['course_name'] == 'INTERNSHIP':
-        return True
-
-    return False
-
-def should_skip_course(course_code, course, completed_courses, current_semester_courses, pre_registered_courses, unlocked_courses):
-    if skip_primary(course, course_code):
-        return True
-    if course_code in completed_courses:
-        completed_courses[course_code]['credit'] = course['credit']
-        return True
-    if course_code in unlocked_courses:
-        return True
-    if (course_code in current_semester_courses and course["course_name"] == current_semester_courses[course_code]["course_name"]) and current_semester_courses[course_code]['grade'] not in ['W', 'I']:
-        return True
-    if course_code in pre_registered_courses:
-        unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course['credit'], 'prerequisites': course['prerequisites'], 'retake': False}
-        return True
-    return False
-
-def are_prerequisites_met(prerequisites, completed_courses, current_semester_courses):
-    for prerequisite in prerequisites:
-        if prerequisite not in completed_courses and prerequisite not in current_semester_courses:
-            return False
-    return True
-
-
-def get_curricumn_data(cookies, session):
-    get_curricumn_link = 'https://portal.aiub.edu/Student/Curriculum'
-    response = session.get(get_curricumn_link, cookies=cookies)
-    soup = BeautifulSoup(response.text, default_parser)
+async def get_curricumn_data(session):
+    soup = make_soup(await portal.get_page(session, '/Student/Curriculum'))
     target_elements = soup.select('[curriculumid]')
     curricumn_id = []
     for target in target_elements:
@@ -348,23 +529,33 @@ def get_curricumn_data(cookies, session):
 
     course_map = {}  # Will contain the course code as key and {coursename, prerequisit[]} as value
 
-    for _id in curricumn_id:
-        course_map.update(process_curriculum(_id, session, cookies))
+    semaphore = asyncio.Semaphore(CURRICULUM_CONCURRENCY)
 
-    return course_map
+    async def fetch(_id):
+        async with semaphore:
+            return await process_curriculum(_id, session)
+
+    async def cached(_id):
+        return await cache.get_or_fill(f'curriculum:{_id}', CURRICULUM_CACHE_TTL, lambda: fetch(_id))
+
+    # gather keeps the page order, so later curricula still override earlier ones
+    for curriculum in await asyncio.gather(*[cached(_id) for _id in curricumn_id]):
+        course_map.update(curriculum)
+
+    # The curricula a student is on, in order, name the merged curriculum for /plan
+    return course_map, '+'.join(curricumn_id)
 
-def process_curriculum(id: str, session, cookies):
+async def process_curriculum(id: str, session):
     # Request the getCurricumnLink?IDd=curriculumId
     course_map = {}
-    response = session.get(f'https://portal.aiub.edu/Common/Curriculum?ID={id}', cookies=cookies)
-    soup = BeautifulSoup(response.text, default_parser)
-    table = soup.select('.table-bordered tr:not(:first-child)')
+    html = await portal.get_page(session, f'/Common/Curriculum?ID={id}')
+    table = select_partial(html, class_strainer('table-bordered'), '.table-bordered tr:not(:first-child)')
 
     for course in table:
         course_code = course.select_one('td:nth-child(1)').text.strip()
         course_name = course.select_one('td:nth-child(2)').text.strip()
         
-        if skip_primary({'course_name': course_name}, course_code):
+        if curriculum_graph.skip_primary({'course_name': course_name}, course_code):
             continue
         
         credit = course.select_one('td:nth-child(3)').text.strip()
@@ -375,30 +566,30 @@ def process_curriculum(id: str, session, cookies):
     return course_map
 
 
-def get_completed_courses(cookies, session, current_semester: str):
-    url = 'https://portal.aiub.edu/Student/GradeReport/ByCurriculum'
-    response = session.get(url, cookies=cookies)
-    soup = BeautifulSoup(response.text, default_parser)
-    rows = soup.select('table:not(:first-child) tr:not(:first-child):has(td:nth-child(3):not(:empty))')
+# (semester) [grade] pairs in the results cell of the grade report
+RESULT_PATTERN = re.compile(r'\(([^)]+)\)\s*\[([^\]]+)\]')
 
+
+async def get_completed_courses(session, current_semester: str):
+    soup = make_soup(await portal.get_page(session, '/Student/GradeReport/ByCurriculum'))
+    return process_grade_report(soup, current_semester)
+
+
+def process_grade_report(soup, current_semester: str):
     completed_courses = {}
     current_semester_courses = {}
     pre_registered_courses = {}
 
     valid_grades = ['A+', 'A', 'B+', 'B', 'C+', 'C', 'D+', 'D', 'F']
 
-    for row in rows:
-        process_row(row, completed_courses, current_semester_courses, pre_registered_courses, valid_grades, current_semester)
+    for course_code, course_name, results in grade_report_rows(soup):
+        process_row(course_code, course_name, results, completed_courses, current_semester_courses, pre_registered_courses, valid_grades, current_semester)
 
     return [completed_courses, current_semester_courses, pre_registered_courses]
 
 
-def process_row(row, completed_courses, current_semester_courses, pre_registered_courses, valid_grades, current_semester):
-    course_code = row.select_one('td:nth-child(1)').text.strip()
-    course_name = row.select_one('td:nth-child(2)').text.strip()
-    results = row.select_one('td:nth-child(3)').text.strip()
-
-    matches = re.findall(r'\(([^)]+)\)\s*\[([^\]]+)\]', results)
+def process_row(course_code, course_name, results, completed_courses, current_semester_courses, pre_registered_courses, valid_grades, current_semester):
+    matches = RESULT_PATTERN.findall(results)
 
     if matches:
 
@@ -440,15 +631,38 @@ def handle_incomplete_grade(matches, course_code, course_name, semester, current
 
 
 
-def process_semester(target, session, cookies):
+async def process_semesters(targets, session):
+    # Fetch the registration pages concurrently and yield each semester as soon as it is parsed
+    semaphore = asyncio.Semaphore(SEMESTER_CONCURRENCY)
+
+    async def fetch(target):
+        async with semaphore:
+            return target.text, await process_semester(target, session)
+
+    tasks = [asyncio.ensure_future(fetch(target)) for target in targets]
+    deadline = deadlines.current_deadline.get()
+    try:
+        for finished in asyncio.as_completed(tasks, timeout=deadline.remaining() if deadline is not None else None):
+            yield await finished
+    except asyncio.TimeoutError:
+        raise deadlines.StageTimeout(deadline.stage_name)
+    except (asyncio.CancelledError, GeneratorExit):
+        metrics.SKIPPED_SEMESTERS.inc(sum(not task.done() for task in tasks))
+        raise
+    finally:
+        # Pages nobody will read any more, e.g. after a timeout or when the client went away
+        for task in tasks:
+            task.cancel()
+
+
+async def process_semester(target, session):
     semesters = {}
     match = re.search(r'q=(.*)', target.attrs['value'])
     if match is not None and len(match.groups()) > 0:
         try:
-            rq_url = 'https://portal.aiub.edu/Student/Registration?q=' + match.group(1)
-            response = session.get(rq_url, cookies=cookies)
-            soup = BeautifulSoup(response.text, default_parser)
-            table = soup.select("table")
+            html = await portal.get_page(session, '/Student/Registration?q=' + match.group(1))
+            # Only the tables are built, the routine is in the second one
+            table = select_partial(html, SoupStrainer('table'), 'table', 2, TABLE_PAGE_PARSERS)
             raw_course_elements = table[1].select("td:first-child")
             courses_obj = {}
             for course in raw_course_elements:
@@ -460,6 +674,8 @@ def process_semester(target, session, cookies):
                     credit = sorted([int(c.strip()) for c in credit.split('-')], reverse=True)[0]
                     courses_obj = process_course_times(course_times, parsed_course, credit, courses_obj)
             semesters[target.text] = courses_obj
+        except (portal.PortalUnavailable, deadlines.StageTimeout):
+            raise
         except Exception as e:
             print('Error in process_semester: ', e)
     return semesters
@@ -473,56 +689,3 @@ def process_course_times(course_times, parsed_course, credit, courses_obj):
             courses_obj[parsed_time['day']] = {}
         courses_obj[parsed_time['day']][parsed_time['time']] = {'course_name': parsed_course['course_name'], 'class_id': parsed_course['class_id'], 'credit': credit, 'section': parsed_course['section'], 'type': parsed_time['type'], 'room': parsed_time['room']}
     return courses_obj
-
-
-def get_course_details(course):
-    match = re.match(r"^(\d+)-(.+?)\s+\[([A-Z0-9]+)\](?:\s+\[([A-Z0-9]+)\])?$", course)
-    try:
-        if match:
-            class_id = match.group(1)
-            course_name = match.group(2).title()
-            section = match.group(4) if match.group(4) else match.group(3)
-            return {"class_id": class_id, "course_name": course_name, "section": section}
-        else:
-            print("Course not found in the string:", course)
-            return {"class_id": "", "course_name": "", "section": ""}
-    except IndexError:
-        print("Course not found in the string:", course)
-        return {"class_id": "", "course_name": "", "section": ""}
-
-
-
-def parse_time(time_string: str):
-    try:
-        match = re.findall(r'\d{1,2}:\d{1,2}(?:\s?[ap]m|\s?[AP]M)?', time_string)
-        day_map = {'Sun': 'Sunday', 'Mon': 'Monday', 'Tue': 'Tuesday', 'Wed': 'Wednesday', 'Thu': 'Thursday', 'Fri': 'Friday', 'Sat': 'Saturday'}
-        class_type = re.search(r'\((.*?)\)', time_string).group(1)
-        day = day_map[re.search(r'(Sun|Mon|Tue|Wed|Thu|Fri|Sat)', time_string).group()]
-        room = re.search(r'Room: (.*)', time_string).group(1)
-        start_time, end_time = match[0], match[1]
-        start_time_obj = ''
-        end_time_obj = ''
-        #if time contains am/pm or AM/PM
-        AM_TIME_FORMAT = '%I:%M'
-        PM_TIME_FORMAT = AM_TIME_FORMAT + ' %p'
-        if "am" in start_time.lower() or "pm" in start_time.lower():
-            start_time_obj = datetime.strptime(start_time, PM_TIME_FORMAT)
-        else:
-            start_time_obj = datetime.strptime(start_time, AM_TIME_FORMAT)
-        if "am" in end_time.lower() or "pm" in end_time.lower():
-            end_time_obj = datetime.strptime(end_time, PM_TIME_FORMAT)
-        else:
-            end_time_obj = datetime.strptime(end_time, AM_TIME_FORMAT)
-
-        start_time_formatted = start_time_obj.strftime(PM_TIME_FORMAT)
-        end_time_formatted = end_time_obj.strftime(PM_TIME_FORMAT)
-        final_time = f"{start_time_formatted} - {end_time_formatted}"
-        data = {
-            "type": class_type,
-            "time": final_time,
-            "day": day,
-            "room": room
-        }
-        return data
-    except IndexError:
-        print("Time not found in the string.")
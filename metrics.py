@@ -0,0 +1,101 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import Histogram, Counter, Gauge, generate_latest, CONTENT_TYPE_LATEST
+
+# Per-stage timings of the login pipeline, exposed at /metrics
+
+STAGES = ['queue', 'login', 'curriculum', 'grades', 'semesters', 'pack']
+
+# total: wall time of the stage, network: time spent in portal requests,
+# parse: time spent building HTML trees. Requests within a stage run concurrently,
+# so network can add up to more than total
+STAGE_SECONDS = Histogram(
+    'aiub_login_stage_seconds', 'Time spent in each stage of a login',
+    ['stage', 'kind'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+LOGIN_SECONDS = Histogram(
+    'aiub_login_seconds', 'Time from the login request to the complete event',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+LOGINS = Counter('aiub_logins_total', 'Finished logins by outcome', ['outcome'])
+
+# Outbound concurrency governor of this worker, see governor.py
+PORTAL_LIMIT = Gauge('aiub_portal_concurrency_limit', 'Adaptive limit on in-flight portal requests')
+PORTAL_IN_FLIGHT = Gauge('aiub_portal_in_flight', 'Portal requests in flight')
+LOGINS_QUEUED = Gauge('aiub_logins_queued', 'Logins waiting for their turn at the portal')
+PORTAL_CIRCUIT = Gauge('aiub_portal_circuit_state', 'Portal circuit breaker, 0 closed, 1 half-open, 2 open')
+
+# Work stopped because every client of a login disconnected, see jobs.py
+ABANDONED_LOGINS = Counter('aiub_logins_abandoned_total', 'Logins cancelled after their clients left, by the stage they were in', ['stage'])
+ABANDONED_REQUESTS = Counter('aiub_portal_requests_abandoned_total', 'Portal requests cancelled while in flight, by why: disconnect, timeout or other', ['cause'])
+SKIPPED_SEMESTERS = Counter('aiub_semester_pages_skipped_total', 'Registration pages not fetched or parsed because the login was cancelled')
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Timer of the login the current task works for. measure() adds network and parse time to
+# whichever stage it is in, from anywhere in the scrape
+current_timer = ContextVar('current_timer', default=None)
+
+
+class StageTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.current = None
+        self.last = None  # Stage entered most recently, kept after it ends
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        # A stage can be entered more than once, its times add up and are observed when the login finishes
+        self.current = name
+        self.last = name
+        self.timings.setdefault(name, {'total': 0.0, 'network': 0.0, 'parse': 0.0})
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name]['total'] += time.perf_counter() - start
+            self.current = None
+
+    def add(self, kind: str, seconds: float):
+        if self.current is not None:
+            self.timings[self.current][kind] += seconds
+
+    def finish(self, outcome: str):
+        for stage, kinds in self.timings.items():
+            for kind, seconds in kinds.items():
+                STAGE_SECONDS.labels(stage, kind).observe(seconds)
+        LOGINS.labels(outcome).inc()
+        if outcome == 'complete':
+            LOGIN_SECONDS.observe(time.perf_counter() - self.started)
+
+    def summary(self) -> dict:
+        # Milliseconds per stage and kind, for the opt-in timings field of the complete event
+        return {stage: {kind: round(seconds * 1000, 1) for kind, seconds in kinds.items()} for stage, kinds in self.timings.items()}
+
+
+def start_timer() -> StageTimer:
+    timer = StageTimer()
+    current_timer.set(timer)
+    return timer
+
+
+def record(kind: str, seconds: float):
+    timer = current_timer.get()
+    if timer is not None:
+        timer.add(kind, seconds)
+
+
+@contextmanager
+def measure(kind: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, time.perf_counter() - start)
+
+
+def latest() -> bytes:
+    return generate_latest()
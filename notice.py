@@ -4,13 +4,12 @@ import os
 import threading
 import redis
 import requests
-from bs4 import BeautifulSoup
+from parsing import select_partial, class_strainer
+from deadlines import PORTAL_CONNECT_TIMEOUT, PORTAL_READ_TIMEOUT
 from pywebpush import webpush, WebPushException
 
 # Configurations
 aiub_home_url = 'https://www.aiub.edu'
-default_parser = 'html.parser'
-
 stop_event = threading.Event()
 
 NOTICE_LEN = 10  # Number of notices to check for new notices
@@ -86,7 +85,8 @@ def format_notice(notice):
         
     if notice.select_one(date_str).text != '':
         date = notice.select_one(date_str).text.strip()
-        parts = date.split('\r\n')
+        # lxml and html5lib normalize the page's \r\n line breaks to \n
+        parts = date.splitlines()
         if len(parts) > 1:
             date = parts[0].strip() + ' ' + parts[1].strip()
         else:
@@ -95,17 +95,21 @@ def format_notice(notice):
     else:
         return title
     
+def select_notices(html: str):
+    # Only the notice section of the homepage is built
+    return select_partial(html, class_strainer('notice-page'), '.notice-page .notification')
+
+
 # Async function to check AIUB notices
 async def fetch_new_notice():
     session = requests.Session()
-    response = session.get(aiub_home_url)
-    soup = BeautifulSoup(response.text, default_parser)
+    response = session.get(aiub_home_url, timeout=(PORTAL_CONNECT_TIMEOUT, PORTAL_READ_TIMEOUT))
 
     notice_list = []
     
     global NOTICE_LEN
     
-    notices = soup.select('.notice-page .notification')
+    notices = select_notices(response.text)
     if len(notices) > 0:
         # Get the last Count notices, If notices are less than Count, get all minimum notices
         NOTICE_LEN = min(NOTICE_LEN, len(notices))
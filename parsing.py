@@ -0,0 +1,162 @@
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
+from bs4.element import NavigableString, PreformattedString
+
+from metrics import measure
+
+# HTML parser backend shared by every scraper.
+# html.parser is pure Python and always available, lxml is several times faster.
+# The tree is always a BeautifulSoup tree, so the scrapers' output does not depend on the backend
+HTML_PARSERS = ['html.parser', 'lxml', 'html5lib']
+
+HTML_PARSER = os.environ.get('HTML_PARSER', 'html.parser')
+
+# Class slots, clock times and course titles repeat across users and semesters, keep this many parsed results
+PARSE_CACHE_SIZE = int(os.environ.get('PARSE_CACHE_SIZE', 4096))
+
+DAY_NAMES = {'Sun': 'Sunday', 'Mon': 'Monday', 'Tue': 'Tuesday', 'Wed': 'Wednesday', 'Thu': 'Thursday', 'Fri': 'Friday', 'Sat': 'Saturday'}
+
+CLOCK_PATTERN = re.compile(r'\d{1,2}:\d{1,2}(?:\s?[ap]m|\s?[AP]M)?')
+CLASS_TYPE_PATTERN = re.compile(r'\((.*?)\)')
+DAY_PATTERN = re.compile(r'(Sun|Mon|Tue|Wed|Thu|Fri|Sat)')
+ROOM_PATTERN = re.compile(r'Room: (.*)')
+COURSE_PATTERN = re.compile(r"^(\d+)-(.+?)\s+\[([A-Z0-9]+)\](?:\s+\[([A-Z0-9]+)\])?$")
+
+AM_TIME_FORMAT = '%I:%M'
+PM_TIME_FORMAT = AM_TIME_FORMAT + ' %p'
+
+
+# Backends select_partial builds partial trees with, html5lib ignores parse_only and always builds the full tree
+PARTIAL_PARSERS = ['html.parser', 'lxml']
+# Pages that are almost all tables leave a strainer little to skip. 'benchmark.py partial' measured
+# the registration page slower with one under html.parser, so it only gets one under lxml
+TABLE_PAGE_PARSERS = ['lxml']
+
+
+def available_parsers() -> list:
+    available = []
+    for name in HTML_PARSERS:
+        try:
+            BeautifulSoup('', name)
+            available.append(name)
+        except FeatureNotFound:
+            pass
+    return available
+
+
+def set_parser(name: str):
+    # Switch the backend, falling back to html.parser when it isn't installed
+    global HTML_PARSER
+    if name not in available_parsers():
+        print(f'HTML parser "{name}" is not available, using html.parser')
+        name = 'html.parser'
+    HTML_PARSER = name
+
+
+def make_soup(markup) -> BeautifulSoup:
+    with measure('parse'):
+        return BeautifulSoup(markup, HTML_PARSER)
+
+
+def class_strainer(name: str) -> SoupStrainer:
+    # SoupStrainer compares the whole class attribute, this matches one class of a multi-class element
+    return SoupStrainer(class_=re.compile(rf'(^|\s){re.escape(name)}(\s|$)'))
+
+
+def select_partial(markup, parse_only: SoupStrainer, selector: str, minimum: int = 1, parsers: list = PARTIAL_PARSERS) -> list:
+    # Build only the subtrees matched by parse_only and select from them when the backend is one of parsers,
+    # else the full page. If the layout changed and fewer than minimum elements match, parse the full page instead
+    if HTML_PARSER in parsers:
+        with measure('parse'):
+            soup = BeautifulSoup(markup, HTML_PARSER, parse_only=parse_only)
+        elements = soup.select(selector)
+        if len(elements) >= minimum:
+            return elements
+        print(f'Partial parse found no match for "{selector}", parsing the full page')
+    return make_soup(markup).select(selector)
+
+
+def is_empty(cell) -> bool:
+    # Same rule as the :empty selector: no child tags and nothing but whitespace (comments don't count)
+    for child in cell.contents:
+        if isinstance(child, PreformattedString):
+            continue
+        if not isinstance(child, NavigableString) or child.strip(' \t\r\n\f'):
+            return False
+    return True
+
+
+def grade_report_rows(soup):
+    # Yields (code, name, results) for every row matched by
+    # 'table:not(:first-child) tr:not(:first-child):has(td:nth-child(3):not(:empty))'
+    # in a single walk over each table instead of one selector match per cell.
+    # Rows are expected to be flat, i.e. the cells are direct children of the tr
+    seen = set()
+    for table in soup.find_all('table'):
+        if table.find_previous_sibling() is None:
+            continue
+        for row in table.find_all('tr'):
+            if id(row) in seen:
+                continue
+            seen.add(id(row))
+            if row.find_previous_sibling() is None:
+                continue
+            cells = row.find_all(recursive=False)
+            if len(cells) < 3 or cells[0].name != 'td' or cells[1].name != 'td' or cells[2].name != 'td' or is_empty(cells[2]):
+                continue
+            yield cells[0].text.strip(), cells[1].text.strip(), cells[2].text.strip()
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def format_clock(clock: str) -> str:
+    # '8:00' or '8:00 am' -> '08:00 AM'
+    if "am" in clock.lower() or "pm" in clock.lower():
+        return datetime.strptime(clock, PM_TIME_FORMAT).strftime(PM_TIME_FORMAT)
+    return datetime.strptime(clock, AM_TIME_FORMAT).strftime(PM_TIME_FORMAT)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_time_cached(time_string: str):
+    # Same lookups, in the same order, as the original parse_time so the same strings fail the same way
+    clocks = CLOCK_PATTERN.findall(time_string)
+    class_type = CLASS_TYPE_PATTERN.search(time_string).group(1)
+    day = DAY_NAMES[DAY_PATTERN.search(time_string).group()]
+    room = ROOM_PATTERN.search(time_string).group(1)
+    if len(clocks) < 2:
+        return None
+    return class_type, f"{format_clock(clocks[0])} - {format_clock(clocks[1])}", day, room
+
+
+def parse_time(time_string: str):
+    # 'Time: Sun 8:00 - 9:30 (Lab) Room: 540' -> {'type': 'Lab', 'time': '08:00 AM - 09:30 AM', 'day': 'Sunday', 'room': '540'}
+    parsed = parse_time_cached(time_string)
+    if parsed is None:
+        print("Time not found in the string.")
+        return None
+    class_type, final_time, day, room = parsed
+    # A new dict every call, callers own what they get back
+    return {"type": class_type, "time": final_time, "day": day, "room": room}
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def get_course_details_cached(course: str):
+    match = COURSE_PATTERN.match(course)
+    if not match:
+        return None
+    return match.group(1), match.group(2).title(), match.group(4) if match.group(4) else match.group(3)
+
+
+def get_course_details(course: str):
+    # '1234-DATA STRUCTURE [A]' -> {'class_id': '1234', 'course_name': 'Data Structure', 'section': 'A'}
+    parsed = get_course_details_cached(course)
+    if parsed is None:
+        print("Course not found in the string:", course)
+        return {"class_id": "", "course_name": "", "section": ""}
+    class_id, course_name, section = parsed
+    return {"class_id": class_id, "course_name": course_name, "section": section}
+
+
+set_parser(HTML_PARSER)
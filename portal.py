@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+import aiohttp
+import redis
+from cryptography.fernet import Fernet, InvalidToken
+from yarl import URL
+
+import cache
+import deadlines
+from breaker import breaker, PortalUnavailable
+from governor import get_governor
+from metrics import measure
+
+# Async client for portal.aiub.edu, shared by the SSE pipeline
+
+# Point AIUB_PORTAL_URL at fake_portal.py to run the pipeline offline
+aiub_portal_url = os.environ.get('AIUB_PORTAL_URL', 'https://portal.aiub.edu').rstrip('/')
+
+# Seconds an authenticated portal session is reused before logging in again
+PORTAL_SESSION_TTL = int(os.environ.get('PORTAL_SESSION_TTL', 600))
+
+
+def new_session() -> aiohttp.ClientSession:
+    # Every login gets its own cookie jar. unsafe=True lets the jar keep cookies
+    # for IP hosts too, so the pipeline can run against a local stand-in portal
+    timeout = aiohttp.ClientTimeout(connect=deadlines.PORTAL_CONNECT_TIMEOUT, sock_read=deadlines.PORTAL_READ_TIMEOUT)
+    return aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True), timeout=timeout)
+
+
+@asynccontextmanager
+async def portal_request():
+    # Every portal request goes through the circuit breaker and a governor slot, and gets
+    # call.timeout to pass on. Raises PortalUnavailable while the circuit is open or when the portal
+    # can't be reached, and StageTimeout when the login's current stage runs out of time
+    breaker.before()
+    reported = False
+    try:
+        async with get_governor().request() as call:
+            call.timeout = deadlines.request_timeout()
+            try:
+                yield call
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # A login out of its own budget says nothing about the portal, that is no failure
+                try:
+                    deadlines.check_expired()
+                except deadlines.StageTimeout as timeout:
+                    raise timeout from e
+                breaker.failure()
+                reported = True
+                raise
+            if call.status is not None and call.status >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            reported = True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Outside the governor's slot, so it still sees what happened to the request
+        raise PortalUnavailable('AIUB portal is not responding. Try again later') from e
+    finally:
+        if not reported:
+            breaker.abandon()
+
+
+async def login(session: aiohttp.ClientSession, username: str, password: str):
+    # Post the credentials and follow the redirect chain like requests did
+    async with portal_request() as call:
+        with measure('network'):
+            async with session.post(aiub_portal_url, data={'UserName': username, 'Password': password}, timeout=call.timeout) as response:
+                call.status = response.status
+                return response.status, str(response.url), await response.text()
+
+
+async def get_page(session: aiohttp.ClientSession, path: str) -> str:
+    async with portal_request() as call:
+        with measure('network'):
+            async with session.get(aiub_portal_url + path, timeout=call.timeout) as response:
+                call.status = response.status
+                return await response.text()
+
+
+async def resume(session: aiohttp.ClientSession):
+    # Student home page using restored cookies, None if the portal bounced them
+    async with portal_request() as call:
+        with measure('network'):
+            async with session.get(aiub_portal_url + '/Student', timeout=call.timeout) as response:
+                call.status = response.status
+                url = str(response.url)
+                if response.status != 200 or not url.startswith(f'{aiub_portal_url}/Student') or 'Student/Tpe/Start' in url:
+                    return None
+                return await response.text()
+
+
+def session_key(key: str) -> str:
+    return f'portal-session:{key}'
+
+
+async def save_cookies(session: aiohttp.ClientSession, key: str, cipher: Fernet):
+    # Keep the authenticated cookie jar, encrypted, so a repeat login can skip the login POST
+    cookies = {cookie.key: cookie.value for cookie in session.cookie_jar}
+    try:
+        await cache.ar.set(session_key(key), cipher.encrypt(json.dumps(cookies).encode('utf-8')), ex=PORTAL_SESSION_TTL)
+    except redis.RedisError as e:
+        print(f'Error in saving portal session: {e}')
+
+
+async def restore_cookies(session: aiohttp.ClientSession, key: str, cipher: Fernet) -> bool:
+    try:
+        saved = await cache.ar.get(session_key(key))
+        if saved is None:
+            return False
+        cookies = json.loads(cipher.decrypt(saved))
+    except (redis.RedisError, InvalidToken) as e:
+        print(f'Error in restoring portal session: {e}')
+        return False
+    session.cookie_jar.update_cookies(cookies, response_url=URL(aiub_portal_url))
+    return True
+
+
+async def forget_cookies(session: aiohttp.ClientSession, key: str):
+    session.cookie_jar.clear()
+    try:
+        await cache.ar.delete(session_key(key))
+    except redis.RedisError as e:
+        print(f'Error in removing portal session: {e}')
@@ -0,0 +1,17 @@
+import asyncio
+
+# Wake-ups shared by the job log and the portal governor
+
+
+class Broadcast:
+    # Something waiters want to hear about again and again. notify() wakes every current waiter,
+    # wait() after that blocks until the next notify(), unlike a plain asyncio.Event that stays set
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    def notify(self):
+        self.event.set()
+        self.event = asyncio.Event()
+
+    async def wait(self):
+        await self.event.wait()
@@ -0,0 +1,86 @@
+import json
+import re
+
+from cache import content_hash
+
+# Incremental sync. Routines of past semesters never change, so a client that already holds
+# one with a matching hash neither waits for it to be fetched nor gets it again. Likewise the
+# sections of the result are versioned, and only the ones the client doesn't hold are sent
+
+SEASONS = {'Fall': 0, 'Spring': 1, 'Summer': 2}  # Order within an academic year, e.g. Fall 2024-25 comes first
+SEMESTER_PATTERN = re.compile(r'(Fall|Spring|Summer)\s+(\d{4})')
+
+# Sections of the login result that are versioned by content hash
+SECTIONS = ('semesterClassRoutine', 'unlockedCourses', 'completedCourses', 'preregisteredCourses', 'curriculumncourses')
+
+
+def semester_order(name: str):
+    # Sort key of a semester name like "Spring 2024-25", None if it can't be parsed
+    match = SEMESTER_PATTERN.search(name)
+    if match is None:
+        return None
+    return int(match.group(2)), SEASONS[match.group(1)]
+
+
+def parse_hashes(raw: str | None):
+    # The known and versions query parameters: a JSON object of name -> hash.
+    # None when the client didn't opt in, invalid values count as knowing nothing
+    if raw is None:
+        return None
+    try:
+        known = json.loads(raw)
+    except ValueError:
+        return {}
+    if not isinstance(known, dict):
+        return {}
+    return {name: value for name, value in known.items() if isinstance(value, str)}
+
+
+def semester_hashes(routine: dict) -> dict:
+    return {name: content_hash(courses) for name, courses in routine.items()}
+
+
+def reusable_semesters(names, current_semester: str, known: dict, stored: dict) -> dict:
+    # Routines of the semesters in names we don't need to fetch: older than the current one,
+    # held by the client and matching our stored copy
+    current = semester_order(current_semester)
+    if current is None:
+        return {}
+
+    reusable = {}
+    for name in names:
+        order = semester_order(name)
+        if order is None or order >= current:
+            continue
+        if name in known and name in stored and known[name] == content_hash(stored[name]):
+            reusable[name] = stored[name]
+    return reusable
+
+
+def section_versions(result: dict) -> dict:
+    return {section: content_hash(result[section]) for section in SECTIONS}
+
+
+def delta(result: dict, known: dict | None, versions: dict | None) -> dict:
+    # Copy of result without what the client already holds unchanged: whole sections
+    # listed in versions and single semesters listed in known
+    stripped = dict(result)
+
+    if versions is not None:
+        current = section_versions(result)
+        unchanged = [section for section in SECTIONS if versions.get(section) == current[section]]
+        for section in unchanged:
+            del stripped[section]
+        stripped['versions'] = current
+        stripped['unchangedSections'] = unchanged
+
+    if known is not None:
+        routine = result['semesterClassRoutine']
+        hashes = semester_hashes(routine)
+        unchanged = [name for name, value in hashes.items() if known.get(name) == value]
+        if 'semesterClassRoutine' in stripped:
+            stripped['semesterClassRoutine'] = {name: courses for name, courses in routine.items() if name not in unchanged}
+        stripped['unchangedSemesters'] = unchanged
+        stripped['semesterHashes'] = hashes
+
+    return stripped
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the top-level modules, notice.py connects to Redis at import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379')
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    # In-memory Redis for the cache, jobs and the governor, and a fresh governor for the test's event loop
+    fakeredis = pytest.importorskip('fakeredis')
+    import cache
+    import governor
+    monkeypatch.setattr(cache, 'ar', fakeredis.FakeAsyncRedis())
+    monkeypatch.setattr(governor, '_governor', None)
+    return cache.ar
@@ -0,0 +1,48 @@
+import copy
+import json
+import random
+
+import pytest
+
+import curriculum_graph
+from unlock_reference import legacy_unlocked_courses, synthetic_curriculum, synthetic_student
+
+PLACEHOLDERS = ['0', 'CSC#1', 'CSC*2', 'CSC4199']
+
+
+@pytest.mark.parametrize('courses', [30, 300])
+def test_unlocked_courses_matches_legacy_walk(courses):
+    rng = random.Random(courses)
+    course_map = synthetic_curriculum(courses, rng)
+    for _ in range(200):
+        completed, current, pre_registered = synthetic_student(course_map, rng)
+        legacy_completed = copy.deepcopy(completed)
+        before = legacy_unlocked_courses(course_map, legacy_completed, current, pre_registered, curriculum_graph.DROPPED_GRADES)
+        graph_completed = copy.deepcopy(completed)
+        curriculum_graph.add_credits(graph_completed, course_map)
+        # The legacy walk only credits offered courses, the placeholders are credited now too
+        for code in PLACEHOLDERS:
+            if code in legacy_completed:
+                legacy_completed[code]['credit'] = course_map[code]['credit']
+        after = curriculum_graph.unlocked_courses(course_map, graph_completed, current, pre_registered)
+        # Same courses in the same order
+        assert json.dumps(after) == json.dumps(before)
+        assert graph_completed == legacy_completed
+
+
+def test_uw_grade_no_longer_blocks_a_course():
+    # main_sse.py used to drop only W and I, a course with a UW grade now counts as not taken, as in app.py
+    assert 'UW' in curriculum_graph.DROPPED_GRADES
+    course_map = {
+        'CSC1103': {'course_name': 'INTRODUCTION TO PROGRAMMING', 'credit': 3, 'prerequisites': []},
+        'CSC1204': {'course_name': 'DISCRETE MATHEMATICS', 'credit': 3, 'prerequisites': []},
+        'CSC2105': {'course_name': 'DATA STRUCTURE', 'credit': 3, 'prerequisites': ['CSC1103']},
+    }
+    current = {
+        'CSC1103': {'course_name': 'INTRODUCTION TO PROGRAMMING', 'grade': 'UW'},
+        'CSC1204': {'course_name': 'DISCRETE MATHEMATICS', 'grade': '-'},
+    }
+    before = legacy_unlocked_courses(course_map, {}, current, {}, ['W', 'I'])
+    after = curriculum_graph.unlocked_courses(course_map, {}, current, {})
+    assert list(before) == ['CSC2105']
+    assert list(after) == ['CSC1103', 'CSC2105']
@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+import deadlines
+
+
+async def slow():
+    await asyncio.sleep(5)
+
+
+async def socket_timeout():
+    # What aiohttp raises when a read times out, ServerTimeoutError is an asyncio.TimeoutError
+    await asyncio.sleep(0)
+    raise asyncio.TimeoutError()
+
+
+def test_run_raises_stage_timeout_when_the_stage_runs_out():
+    async def main():
+        deadline = deadlines.Deadline(0.5)
+        with deadline.stage('login'):
+            await deadline.run(slow())
+
+    with pytest.raises(deadlines.StageTimeout) as e:
+        asyncio.run(main())
+    assert e.value.stage == 'login'
+
+
+def test_run_raises_other_timeouts_as_they_are():
+    async def main():
+        deadline = deadlines.Deadline(30)
+        with deadline.stage('login'):
+            await deadline.run(socket_timeout())
+
+    with pytest.raises(asyncio.TimeoutError) as e:
+        asyncio.run(main())
+    assert not isinstance(e.value, deadlines.StageTimeout)
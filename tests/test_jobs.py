@@ -0,0 +1,30 @@
+import asyncio
+import json
+
+import cache
+import fake_portal
+import jobs
+import main_sse
+import portal
+
+
+def parse(event: bytes) -> dict:
+    return json.loads(event.split(b'data: ', 1)[1])
+
+
+def test_login_after_a_cancelled_one_runs_again(fake_redis, monkeypatch):
+    monkeypatch.setattr(portal, 'aiub_portal_url', fake_portal.start_in_thread(latency=0.05))
+    portal.breaker.success()
+    key = cache.credentials_key('user', 'secret')
+
+    async def main():
+        first = main_sse.login_stream('user', 'secret')
+        await anext(first)
+        # Every client left, the next login for the same credentials comes in before the job has wound down
+        jobs.cancel(jobs._jobs[key])
+        events = [parse(event) async for event in main_sse.login_stream('user', 'secret')]
+        await first.aclose()
+        return events
+
+    events = asyncio.run(main())
+    assert events[-1]['status'] == 'complete', events[-1]
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+import fake_portal
+import main_sse
+import notice
+import parsing
+import portal
+from fake_portal import load_fixture
+from parsing import make_soup
+
+# Every scraper must give the same output whichever backend builds its tree
+
+
+async def scrape_fixtures() -> dict:
+    # Output of every page scraper on the recorded pages
+    async with portal.new_session() as session:
+        await portal.login(session, 'user', 'secret')
+        targets = make_soup(await portal.get_page(session, '/Student')).select('#SemesterDropDown > option')
+        return {
+            'process_curriculum': [await main_sse.process_curriculum(_id, session) for _id in ['101', '102', '103', '104']],
+            'get_completed_courses': await main_sse.get_completed_courses(session, 'Spring 2024-25'),
+            'process_semester': [await main_sse.process_semester(target, session) for target in targets[1:]],
+            'format_notice': [notice.format_notice(n) for n in notice.select_notices(load_fixture('aiub_home.html'))],
+        }
+
+
+@pytest.fixture(scope='module')
+def outputs():
+    portal.aiub_portal_url = fake_portal.start_in_thread()
+    default = parsing.HTML_PARSER
+    outputs = {}
+    try:
+        for backend in parsing.available_parsers():
+            parsing.set_parser(backend)
+            outputs[backend] = asyncio.run(scrape_fixtures())
+    finally:
+        parsing.set_parser(default)
+    return outputs
+
+
+def test_html_parser_scrapes_fixtures(outputs):
+    reference = outputs['html.parser']
+    assert all(reference['process_curriculum'][:3])
+    assert reference['get_completed_courses']
+    assert reference['process_semester']
+    assert reference['format_notice']
+
+
+@pytest.mark.parametrize('backend', [name for name in parsing.HTML_PARSERS if name != 'html.parser'])
+@pytest.mark.parametrize('scraper', ['process_curriculum', 'get_completed_courses', 'process_semester', 'format_notice'])
+def test_backend_matches_html_parser(outputs, backend, scraper):
+    if backend not in outputs:
+        pytest.skip(f'{backend} is not installed')
+    assert outputs[backend][scraper] == outputs['html.parser'][scraper]
@@ -0,0 +1,43 @@
+import asyncio
+import json
+import socket
+
+import cache
+import main_sse
+import portal
+
+
+def refused_url() -> str:
+    # A local port nothing listens on
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f'http://127.0.0.1:{port}'
+
+
+async def login_events(username: str, password: str) -> list:
+    return [json.loads(event.split(b'data: ', 1)[1]) async for event in main_sse.login_stream(username, password)]
+
+
+def test_unreachable_portal_serves_snapshot(fake_redis, monkeypatch):
+    monkeypatch.setattr(portal, 'aiub_portal_url', refused_url())
+    portal.breaker.success()
+    result = {'user': 'Student', 'semesterClassRoutine': {}}
+
+    async def main():
+        key = cache.credentials_key('user', 'secret')
+        await cache.save_snapshot(key, cache.credentials_cipher('user', 'secret'), result)
+        return await login_events('user', 'secret')
+
+    events = asyncio.run(main())
+    assert portal.breaker.state == 'closed'
+    assert events[-1]['status'] == 'complete'
+    assert events[-1]['stale'] is True
+    assert events[-1]['result'] == result
+
+
+def test_unreachable_portal_without_snapshot(fake_redis, monkeypatch):
+    monkeypatch.setattr(portal, 'aiub_portal_url', refused_url())
+    portal.breaker.success()
+    events = asyncio.run(login_events('user', 'secret'))
+    assert events[-1] == {'status': 'error', 'message': 'AIUB portal is not responding. Try again later'}
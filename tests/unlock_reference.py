@@ -0,0 +1,65 @@
+import random
+
+# Reference for curriculum_graph.unlocked_courses: main_sse.py's walk from before it, and synthetic
+# curricula and students to compare the two on. Only the standard library, so no app code can change it
+
+
+def legacy_unlocked_courses(course_map, completed_courses, current_semester_courses, pre_registered_courses, dropped_grades=('W', 'I', 'UW')):
+    # main_sse.py before curriculum_graph, which dropped only W and I. app.py's UW rule is now canonical
+    def skip_primary(course, course_code):
+        return course_code == '0' or '#' in course_code or '*' in course_code or course['course_name'] == 'INTERNSHIP'
+
+    unlocked_courses = {}
+    for course_code, course in completed_courses.items():
+        if course['grade'] == 'D':
+            unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course_map[course_code]['credit'], 'prerequisites': course_map[course_code]['prerequisites'], 'retake': True}
+
+    for course_code, course in course_map.items():
+        if skip_primary(course, course_code):
+            continue
+        if course_code in completed_courses:
+            completed_courses[course_code]['credit'] = course['credit']
+            continue
+        if course_code in unlocked_courses:
+            continue
+        if (course_code in current_semester_courses and course['course_name'] == current_semester_courses[course_code]['course_name']) and current_semester_courses[course_code]['grade'] not in dropped_grades:
+            continue
+        if course_code in pre_registered_courses:
+            unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course['credit'], 'prerequisites': course['prerequisites'], 'retake': False}
+            continue
+        if all(p in completed_courses or p in current_semester_courses for p in course['prerequisites']):
+            unlocked_courses[course_code] = {'course_name': course['course_name'], 'credit': course['credit'], 'prerequisites': course['prerequisites'], 'retake': False}
+    return unlocked_courses
+
+
+def synthetic_curriculum(courses: int, rng: random.Random) -> dict:
+    # Courses with up to 4 prerequisites among the earlier ones or outside the curriculum,
+    # plus the placeholder rows the portal lists
+    course_map = {}
+    codes = []
+    for i in range(courses):
+        code = f'CSC{1000 + i}'
+        pool = codes[-200:] + [f'EXT{rng.randrange(50)}']
+        prerequisites = rng.sample(pool, min(len(pool), rng.choice([0, 0, 1, 1, 2, 3, 4])))
+        course_map[code] = {'course_name': f'COURSE {i}', 'credit': rng.choice([1, 3, 4]), 'prerequisites': prerequisites}
+        codes.append(code)
+    for code, name in [('0', 'ELECTIVE'), ('CSC#1', 'MAJOR ELECTIVE'), ('CSC*2', 'ALTERNATIVE'), ('CSC4199', 'INTERNSHIP')]:
+        course_map[code] = {'course_name': name, 'credit': 3, 'prerequisites': []}
+    return course_map
+
+
+def synthetic_student(course_map: dict, rng: random.Random):
+    codes = list(course_map)
+    progress = rng.random()
+    completed = {}
+    for code in codes[:int(len(codes) * progress)]:
+        if rng.random() < 0.85:
+            completed[code] = {'course_name': course_map[code]['course_name'], 'grade': rng.choice(['A+', 'A', 'B', 'C', 'D']), 'semester': 'Fall 2023-24'}
+    for i in range(rng.randrange(5)):
+        completed[f'EXT{rng.randrange(50)}'] = {'course_name': 'TRANSFER', 'grade': 'B', 'semester': 'Fall 2022-23'}
+    current = {}
+    for code in rng.sample(codes, min(len(codes), 5)):
+        name = course_map[code]['course_name'] if rng.random() < 0.9 else 'RENAMED'
+        current[code] = {'course_name': name, 'grade': rng.choice(['-', '-', '-', 'W', 'I', 'UW'])}
+    pre_registered = {code: {'course_name': course_map[code]['course_name'], 'grade': '-'} for code in rng.sample(codes, min(len(codes), 3))}
+    return completed, current, pre_registered